@@ -0,0 +1,315 @@
+import argparse
+import json
+import sys
+import threading
+import time
+import tracemalloc
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+import similarweb
+
+USER_KEY = 'bench'
+CALLS = 200
+REPEAT = 3
+DOMAIN = 'example.com'
+BASELINE = 'bench_baseline.json'
+TOLERANCE = 0.2
+BATCH_TOLERANCE = 0.5
+BATCH_DOMAINS = 200
+BATCH_DELAY = 0.005
+BATCH_WORKERS = (1, 4, 16, 32)
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = json.dumps({'foo': 'bar'}).encode('utf-8')
+
+    def do_GET(self):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        if self.headers.get('Connection', '').lower() == 'close':
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(delay=0):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _StubHandler)
+    server.daemon_threads = True
+    server.request_queue_size = 256
+    server.delay = delay
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def stub_client(server, **kwargs):
+    host = '127.0.0.1:{0}'.format(server.server_address[1])
+    return similarweb.Client(USER_KEY, use_https=False, host=host, **kwargs)
+
+
+class _CannedTransport(object):
+
+    def get(self, url, params=None, timeout=None):
+        prepared = requests.models.PreparedRequest()
+        prepared.prepare_url(url, params)
+        r = requests.Response()
+        r.status_code = 200
+        r.url = prepared.url
+        r._content = _StubHandler.body
+        return r
+
+
+def endpoint_args(name):
+    if name in similarweb._GRANULARITY_ENDPOINTS:
+        return (DOMAIN, '1-2024', '6-2024', 'monthly')
+    if name in similarweb._PAGE_ENDPOINTS:
+        return (DOMAIN, '1-2024', '6-2024')
+    if name == 'top_sites':
+        return ('Sports', 'us')
+    return (DOMAIN,)
+
+
+def timeit(fn, calls=CALLS, repeat=REPEAT):
+    fn()
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(calls):
+            fn()
+        best = min(best, (time.perf_counter() - start) / calls)
+    return best
+
+
+def peak_bytes(fn, calls=CALLS):
+    fn()
+    tracemalloc.start()
+    try:
+        peak = 0
+        for _ in range(calls):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            fn()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+        return peak
+    finally:
+        tracemalloc.stop()
+
+
+def _endpoint_calls(client):
+    for name in similarweb._ENDPOINT_METHODS:
+        if name == 'adult':
+            continue
+        method = getattr(client, name)
+        args = endpoint_args(name)
+        yield name, lambda method=method, args=args: method(*args)
+
+
+def bench_endpoints(results, server):
+    for name, call in _endpoint_calls(stub_client(server)):
+        results['calls_per_sec.' + name] = 1 / timeit(call)
+    overhead = similarweb.Client(USER_KEY, transport=_CannedTransport())
+    for name, call in _endpoint_calls(overhead):
+        results['overhead_us.' + name] = timeit(call) * 1e6
+        results['peak_bytes.' + name] = peak_bytes(call, CALLS // 10)
+
+
+def _legacy_request(client, domain):
+    params = {
+        'gr': 'monthly',
+        'start': '1-2024',
+        'end': '6-2024',
+        'md': False,
+        'format': 'JSON',
+        'userkey': USER_KEY
+    }
+    return client.api_base_url_site.format(
+        domain=domain, version='v1', endpoint='visits'), params
+
+
+def _precompiled_request(client, domain):
+    params = client._get_granularity_params(
+        '1-2024', '6-2024', 'monthly', False)
+    return client._site_prefix + domain + '/v1/visits', params
+
+
+def bench_request_building(results):
+    client = similarweb.Client(USER_KEY)
+    for name, build in (('legacy_format', _legacy_request),
+                        ('precompiled', _precompiled_request)):
+        results['request_build_ns.' + name] = timeit(
+            lambda: build(client, DOMAIN), CALLS * 100) * 1e9
+
+
+def bench_batch(results):
+    server = start_stub_server(BATCH_DELAY)
+    domains = ['site{0}.example.com'.format(i) for i in range(BATCH_DOMAINS)]
+    try:
+        for workers in BATCH_WORKERS:
+            client = stub_client(server, pool_size=workers)
+
+            def run():
+                for _ in client.bulk('traffic', domains, workers=workers):
+                    pass
+            results['batch_calls_per_sec.workers_{0}'.format(workers)] = (
+                len(domains) / timeit(run, calls=1))
+    finally:
+        server.shutdown()
+
+
+def bench_session_pool(results, server):
+    pooled = stub_client(server)
+    unpooled = stub_client(server, keep_alive=False)
+    results['session_us.keep_alive'] = timeit(
+        lambda: pooled.traffic(DOMAIN)) * 1e6
+    results['session_us.no_keep_alive'] = timeit(
+        lambda: unpooled.traffic(DOMAIN)) * 1e6
+
+
+def _payloads():
+    referrals = {
+        'Data': [
+            {'Site': 'site{0}.example.com'.format(i), 'Value': i / 1e4,
+             'Change': -i / 1e3}
+            for i in range(1000)],
+        'ResultsCount': 1000,
+        'StartDate': '01/2024',
+        'EndDate': '06/2024',
+    }
+    top_sites = {
+        'TopSites': [
+            {'Site': 'site{0}.example.com'.format(i), 'Rank': i + 1}
+            for i in range(50)],
+    }
+    visits = {
+        'Values': [
+            {'Date': '2024-01-{0:02d}'.format(i % 28 + 1), 'Value': i * 1.5}
+            for i in range(180)],
+        'Granularity': 'Daily',
+    }
+    return [('referrals', referrals), ('top_sites', top_sites),
+            ('visits', visits)]
+
+
+def bench_decode(results):
+    for name, payload in _payloads():
+        content = json.dumps(payload).encode('utf-8')
+        results['decode_us.stdlib_text.' + name] = timeit(
+            lambda: json.loads(content.decode('utf-8'))) * 1e6
+        results['decode_us.default.' + name] = timeit(
+            lambda: similarweb._json_loads(content)) * 1e6
+
+
+def retained_bytes(fn):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = fn()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+
+def bench_projection(results):
+    payload = dict(_payloads())['referrals']
+    for record in payload['Data']:
+        record.update(
+            Category='Sports/Football', Share=record['Value'] / 2,
+            Url='https://' + record['Site'] + '/landing')
+    content = json.dumps(payload).encode('utf-8')
+    fields = ('Site', 'Value')
+
+    def full():
+        return similarweb._json_loads(content)
+
+    def projected():
+        return similarweb.ProjectedRecords.from_response(
+            similarweb._json_loads(content), fields)
+
+    for name, decode in (('full', full), ('projected', projected)):
+        results['projection_us.' + name] = timeit(decode) * 1e6
+        results['projection_retained_bytes.' + name] = retained_bytes(decode)
+
+
+def _higher_is_better(name):
+    return name.split('.', 1)[0].endswith('_per_sec')
+
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    regressions = []
+    for name in sorted(results):
+        if not baseline.get(name):
+            continue
+        ratio = results[name] / baseline[name]
+        if _higher_is_better(name):
+            ratio = 1 / ratio if ratio else float('inf')
+        limit = tolerance
+        if name.startswith('batch_'):
+            limit = max(tolerance, BATCH_TOLERANCE)
+        if ratio > 1 + limit:
+            regressions.append((name, baseline[name], results[name]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the similarweb client overhead.')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true',
+                        help='save the results as the new baseline')
+    parser.add_argument('--check', action='store_true',
+                        help='fail if any result regressed past tolerance')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--only', help='run only benchmarks with this prefix')
+    args = parser.parse_args(argv)
+
+    server = start_stub_server()
+    benches = [
+        ('decode', lambda results: bench_decode(results)),
+        ('projection', lambda results: bench_projection(results)),
+        ('request', lambda results: bench_request_building(results)),
+        ('session', lambda results: bench_session_pool(results, server)),
+        ('endpoints', lambda results: bench_endpoints(results, server)),
+        ('batch', lambda results: bench_batch(results)),
+    ]
+    results = {}
+    try:
+        for name, bench in benches:
+            if not args.only or name.startswith(args.only):
+                bench(results)
+    finally:
+        server.shutdown()
+
+    print('decoder: {0}'.format(similarweb._json_loads.__module__))
+    for name in sorted(results):
+        print('{0:<50} {1:>14.1f}'.format(name, results[name]))
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.check:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name, before, after in regressions:
+            print('REGRESSION {0}: {1:.1f} -> {2:.1f}'.format(
+                name, before, after))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,116 +1,1681 @@
+import argparse
+import array
+import asyncio
+import bisect
+import collections
+import concurrent.futures
+import csv
+import datetime
+import email.utils
+import functools
+import hashlib
+import itertools
 import json
+import mmap
+import multiprocessing
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+import urllib.parse
 
 import requests
+import requests.adapters
 
-_API_BASE_URL_SITE = 'api.similarweb.com/Site/{domain}/{version}/{endpoint}'
-_API_BASE_URL = 'api.similarweb.com/{version}/{endpoint}'
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
+
+_API_HOST = 'api.similarweb.com'
+_API_SITE_PATH = '/Site/'
+_API_BASE_URL_SITE = _API_SITE_PATH + '{domain}/{version}/{endpoint}'
+_API_BASE_URL = '/{version}/{endpoint}'
+
+_THROTTLE_STATUS = (429, 503)
+
+_DAY = 24 * 60 * 60
+_CACHE_TTL = {
+    'category': _DAY,
+    'tags': _DAY,
+    'similar_sites': _DAY,
+    'traffic': _DAY,
+    'top_sites': _DAY,
+}
+
+
+def make_session(pool_size=10, keep_alive=True):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    if not keep_alive:
+        session.headers['Connection'] = 'close'
+    return session
+
+
+class SimilarWebError(Exception):
+    retryable = False
+
+    def __init__(self, message, status_code=None, body=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+        self.body = body
+
+
+class AuthError(SimilarWebError):
+    pass
+
+
+class QuotaError(SimilarWebError):
+    retryable = True
+
+
+class NotFoundError(SimilarWebError):
+    pass
+
+
+class ServerError(SimilarWebError):
+    retryable = True
+
+
+class RequestTimeoutError(SimilarWebError):
+    retryable = True
+
+
+_HTTP_ERRORS = {
+    401: AuthError,
+    403: AuthError,
+    404: NotFoundError,
+    429: QuotaError,
+}
+
+
+def _http_error(response):
+    status = response.status_code
+    cls = _HTTP_ERRORS.get(
+        status, ServerError if status >= 500 else SimilarWebError)
+    return cls("HTTP {0} ".format(status) + response.text, status,
+               response.text)
+
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+def _date_ordinal(value):
+    return datetime.date(
+        int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal()
+
+
+class TimeSeries(object):
+    __slots__ = ('dates', 'values', 'granularity')
+
+    def __init__(self, dates, values, granularity=None):
+        self.dates = dates
+        self.values = values
+        self.granularity = granularity
+
+    @classmethod
+    def from_response(cls, res):
+        dates = array.array('q')
+        values = array.array('d')
+        for point in res.get('Values') or ():
+            dates.append(_date_ordinal(point['Date']))
+            value = point['Value']
+            values.append(float('nan') if value is None else value)
+        return cls(dates, values, res.get('Granularity'))
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        for ordinal, value in zip(self.dates, self.values):
+            yield datetime.date.fromordinal(ordinal), value
+
+    def __eq__(self, other):
+        return (isinstance(other, TimeSeries) and
+                self.dates == other.dates and self.values == other.values)
+
+    def __repr__(self):
+        return 'TimeSeries({0} points, granularity={1!r})'.format(
+            len(self), self.granularity)
+
+    def to_numpy(self):
+        import numpy
+        return (numpy.frombuffer(self.dates, dtype=numpy.int64),
+                numpy.frombuffer(self.values, dtype=numpy.float64))
+
+    def to_pandas(self):
+        import pandas
+        dates, values = self.to_numpy()
+        index = pandas.to_datetime(dates - _EPOCH_ORDINAL, unit='D')
+        return pandas.Series(values, index=index, copy=False)
+
+
+class ComparisonTable(object):
+    __slots__ = ('dates', 'columns', 'errors')
+
+    def __init__(self, dates, columns, errors=None):
+        self.dates = dates
+        self.columns = columns
+        self.errors = errors or {}
+
+    @classmethod
+    def from_series(cls, series, errors=None):
+        dates = set()
+        for s in series.values():
+            dates.update(s.dates)
+        dates = array.array('q', sorted(dates))
+        positions = None
+        columns = collections.OrderedDict()
+        for key, s in series.items():
+            if s.dates == dates:
+                columns[key] = s.values
+                continue
+            if positions is None:
+                positions = dict((d, i) for i, d in enumerate(dates))
+            column = array.array('d', [float('nan')]) * len(dates)
+            for ordinal, value in zip(s.dates, s.values):
+                column[positions[ordinal]] = value
+            columns[key] = column
+        return cls(dates, columns, errors)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def __repr__(self):
+        return 'ComparisonTable({0} dates, {1} columns)'.format(
+            len(self.dates), len(self.columns))
+
+    def to_numpy(self):
+        import numpy
+        return (numpy.frombuffer(self.dates, dtype=numpy.int64),
+                dict((key, numpy.frombuffer(column, dtype=numpy.float64))
+                     for key, column in self.columns.items()))
+
+    def to_pandas(self):
+        import pandas
+        dates, columns = self.to_numpy()
+        index = pandas.to_datetime(dates - _EPOCH_ORDINAL, unit='D')
+        return pandas.DataFrame(
+            columns, index=index, columns=list(self.columns))
+
+
+class ProjectedRecords(object):
+    __slots__ = ('fields', 'columns', 'meta')
+
+    def __init__(self, fields, columns, meta=None):
+        self.fields = tuple(fields)
+        self.columns = columns
+        self.meta = meta or {}
+
+    @classmethod
+    def from_response(cls, res, fields):
+        records = res.get('Data') or ()
+        columns = tuple(
+            [record.get(field) for record in records] for field in fields)
+        meta = dict((k, v) for k, v in res.items() if k != 'Data')
+        return cls(fields, columns, meta)
+
+    def __len__(self):
+        return len(self.columns[0]) if self.columns else 0
+
+    def __getitem__(self, index):
+        return dict(
+            (field, column[index])
+            for field, column in zip(self.fields, self.columns))
+
+    def __iter__(self):
+        for values in zip(*self.columns):
+            yield dict(zip(self.fields, values))
+
+    def column(self, field):
+        return self.columns[self.fields.index(field)]
+
+    def __repr__(self):
+        return 'ProjectedRecords({0} records, fields={1!r})'.format(
+            len(self), self.fields)
+
+
+def _month_index(value):
+    month, year = value.split('-')
+    return int(year) * 12 + int(month) - 1
+
+
+def _month_string(index):
+    return '{0}-{1}'.format(index % 12 + 1, index // 12)
+
+
+def _month_ordinals(index):
+    first = datetime.date(index // 12, index % 12 + 1, 1).toordinal()
+    following = datetime.date(
+        (index + 1) // 12, (index + 1) % 12 + 1, 1).toordinal()
+    return first, following
+
+
+class TimeSeriesStore(object):
+
+    def __init__(self, path=':memory:'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS points ('
+            'domain TEXT, metric TEXT, gr TEXT, md INTEGER, date INTEGER, '
+            'value REAL, PRIMARY KEY (domain, metric, gr, md, date));'
+            'CREATE TABLE IF NOT EXISTS months ('
+            'domain TEXT, metric TEXT, gr TEXT, md INTEGER, month INTEGER, '
+            'fetched REAL, PRIMARY KEY (domain, metric, gr, md, month));')
+
+    def months(self, key):
+        with self._lock:
+            return set(row[0] for row in self._db.execute(
+                'SELECT month FROM months WHERE domain = ? AND metric = ? '
+                'AND gr = ? AND md = ?', key))
+
+    def put(self, key, months, series):
+        months = list(months)
+        first = _month_ordinals(min(months))[0]
+        following = _month_ordinals(max(months))[1]
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM points WHERE domain = ? AND metric = ? '
+                'AND gr = ? AND md = ? AND date >= ? AND date < ?',
+                tuple(key) + (first, following))
+            self._db.executemany(
+                'INSERT INTO points VALUES (?, ?, ?, ?, ?, ?)',
+                (tuple(key) + (ordinal, value)
+                 for ordinal, value in zip(series.dates, series.values)
+                 if first <= ordinal < following))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO months VALUES (?, ?, ?, ?, ?, ?)',
+                (tuple(key) + (month, now) for month in months))
+
+    def get(self, key, start, end):
+        first = _month_ordinals(_month_index(start))[0]
+        following = _month_ordinals(_month_index(end))[1]
+        dates = array.array('q')
+        values = array.array('d')
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT date, value FROM points WHERE domain = ? '
+                'AND metric = ? AND gr = ? AND md = ? AND date >= ? '
+                'AND date < ? ORDER BY date',
+                tuple(key) + (first, following))
+            for ordinal, value in rows:
+                dates.append(ordinal)
+                values.append(float('nan') if value is None else value)
+        return TimeSeries(dates, values, key[2])
+
+    def close(self):
+        self._db.close()
+
+
+def _ranked(res):
+    for rank, (domain, score) in enumerate(_neighbors(res), 1):
+        yield rank, domain
+
+
+class Snapshot(object):
+
+    def __init__(self, path=':memory:'):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS top_sites ('
+            'category TEXT, country TEXT, rank INTEGER, domain TEXT, '
+            'PRIMARY KEY (category, country, rank));'
+            'CREATE INDEX IF NOT EXISTS top_sites_domain '
+            'ON top_sites (domain, category, country);'
+            'CREATE TABLE IF NOT EXISTS categories ('
+            'domain TEXT PRIMARY KEY, category TEXT, rank INTEGER);'
+            'CREATE INDEX IF NOT EXISTS categories_category '
+            'ON categories (category, rank);'
+            'CREATE TABLE IF NOT EXISTS loads ('
+            'kind TEXT, key TEXT, loaded REAL, PRIMARY KEY (kind, key));')
+
+    def load(self, client, top_sites=(), domains=(), workers=8):
+        jobs = [('top_sites', (category or '', country or ''))
+                for category, country in top_sites]
+        jobs += [('category_rank', domain.strip().lower())
+                 for domain in domains]
+
+        def fetch(job):
+            if job[0] == 'top_sites':
+                return client.top_sites(*job[1])
+            return client.category_rank(job[1])
+
+        errors = []
+        for job, result in client._fan_out(fetch, jobs, workers):
+            if isinstance(result, Exception):
+                errors.append((job, result))
+            elif job[0] == 'top_sites':
+                self._put_top_sites(job[1], result)
+            else:
+                self._put_category(job[1], result)
+        return errors
+
+    def _put_top_sites(self, key, res):
+        category, country = key
+        with self._lock, self._db:
+            self._db.execute(
+                'DELETE FROM top_sites WHERE category = ? AND country = ?',
+                key)
+            self._db.executemany(
+                'INSERT INTO top_sites VALUES (?, ?, ?, ?)',
+                ((category, country, rank, domain)
+                 for rank, domain in _ranked(res)))
+            self._loaded('top_sites', json.dumps(key))
+
+    def _put_category(self, domain, res):
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO categories VALUES (?, ?, ?)',
+                (domain, res.get('Category'), res.get('CategoryRank')))
+            self._loaded('category_rank', domain)
+
+    def _loaded(self, kind, key):
+        self._db.execute(
+            'INSERT OR REPLACE INTO loads VALUES (?, ?, ?)',
+            (kind, key, time.time()))
+
+    def stale(self, max_age):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT kind, key FROM loads WHERE loaded < ? ORDER BY key',
+                (time.time() - max_age,)).fetchall()
+        top_sites = [tuple(json.loads(key)) for kind, key in rows
+                     if kind == 'top_sites']
+        domains = [key for kind, key in rows if kind == 'category_rank']
+        return top_sites, domains
+
+    def refresh(self, client, max_age, workers=8):
+        top_sites, domains = self.stale(max_age)
+        return self.load(client, top_sites, domains, workers)
+
+    def top_sites(self, category=None, country=None):
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                'SELECT domain FROM top_sites WHERE category = ? '
+                'AND country = ? ORDER BY rank',
+                (category or '', country or ''))]
+
+    def top_sites_rank(self, domain, category=None, country=None):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT rank FROM top_sites WHERE domain = ? '
+                'AND category = ? AND country = ?',
+                (domain.strip().lower(), category or '',
+                 country or '')).fetchone()
+        return row[0] if row else None
+
+    def category(self, domain):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT category FROM categories WHERE domain = ?',
+                (domain.strip().lower(),)).fetchone()
+        return row[0] if row else None
+
+    def category_rank(self, domain, category=None):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT category, rank FROM categories WHERE domain = ?',
+                (domain.strip().lower(),)).fetchone()
+        if row is None or (category is not None and row[0] != category):
+            return None
+        return row[1]
+
+    def close(self):
+        self._db.close()
+
+
+def _cache_key(url, params):
+    return url + '?' + urllib.parse.urlencode(
+        sorted((k, v) for k, v in params.items() if k != 'userkey'))
+
+
+class Cache(object):
+
+    def __init__(self, ttl=None, default_ttl=60 * 60, track_accesses=False):
+        self.ttl = dict(_CACHE_TTL)
+        if ttl:
+            self.ttl.update(ttl)
+        unknown = set(self.ttl).difference(_API_ENDPOINTS)
+        if unknown:
+            raise ValueError("Unknown cache TTL endpoint: {0}".format(
+                ', '.join(sorted(unknown))))
+        self._ttl = dict((_API_ENDPOINTS[name], seconds)
+                         for name, seconds in self.ttl.items())
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+        self.track_accesses = track_accesses
+        self._lock = threading.Lock()
+
+    def ttl_for(self, url):
+        return self._ttl.get(url.rsplit('/', 1)[-1], self.default_ttl)
+
+    def get(self, key):
+        with self._lock:
+            value = self._get(key, time.time())
+            if self.track_accesses:
+                self._count(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, ttl):
+        if ttl > 0:
+            with self._lock:
+                self._set(key, value, time.time() + ttl)
+
+    def access_counts(self, keys):
+        with self._lock:
+            return self._access_counts(list(keys))
+
+    def decay_accesses(self):
+        with self._lock:
+            self._decay_accesses()
+
+    def _get(self, key, now):
+        raise NotImplementedError
+
+    def _set(self, key, value, expires):
+        raise NotImplementedError
+
+    def _count(self, key):
+        raise NotImplementedError
+
+    def _access_counts(self, keys):
+        raise NotImplementedError
+
+    def _decay_accesses(self):
+        raise NotImplementedError
+
+
+class MemoryCache(Cache):
+
+    def __init__(self, maxsize=1024, **kwargs):
+        Cache.__init__(self, **kwargs)
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._accesses = collections.Counter()
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _set(self, key, value, expires):
+        self._entries[key] = (expires, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _count(self, key):
+        self._accesses[key] += 1
+
+    def _access_counts(self, keys):
+        return dict((key, self._accesses[key]) for key in keys)
+
+    def _decay_accesses(self):
+        for key, count in list(self._accesses.items()):
+            if count > 1:
+                self._accesses[key] = count // 2
+            else:
+                del self._accesses[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache(Cache):
+
+    def __init__(self, path, **kwargs):
+        Cache.__init__(self, **kwargs)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(
+            'CREATE TABLE IF NOT EXISTS cache '
+            '(key TEXT PRIMARY KEY, expires REAL, value BLOB);'
+            'CREATE TABLE IF NOT EXISTS accesses '
+            '(key TEXT PRIMARY KEY, count INTEGER);')
+
+    def _get(self, key, now):
+        row = self._db.execute(
+            'SELECT expires, value FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return None
+        if row[0] <= now:
+            self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+            self._db.commit()
+            return None
+        return row[1]
+
+    def _set(self, key, value, expires):
+        self._db.execute(
+            'INSERT OR REPLACE INTO cache (key, expires, value) '
+            'VALUES (?, ?, ?)', (key, expires, value))
+        self._db.commit()
+
+    def _count(self, key):
+        with self._db:
+            self._db.execute(
+                'INSERT OR IGNORE INTO accesses VALUES (?, 0)', (key,))
+            self._db.execute(
+                'UPDATE accesses SET count = count + 1 WHERE key = ?', (key,))
+
+    def _access_counts(self, keys):
+        counts = dict.fromkeys(keys, 0)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            counts.update(self._db.execute(
+                'SELECT key, count FROM accesses WHERE key IN ({0})'.format(
+                    ','.join('?' * len(chunk))), chunk))
+        return counts
+
+    def _decay_accesses(self):
+        with self._db:
+            self._db.execute('UPDATE accesses SET count = count / 2')
+            self._db.execute('DELETE FROM accesses WHERE count = 0')
+
+    def close(self):
+        self._db.close()
+
+
+class Warmer(object):
+
+    def __init__(self, client, manifest, window=0, rate=None, budget=None,
+                 ttl=None, workers=8):
+        if client.cache is None or not client.cache.track_accesses:
+            raise ValueError(
+                "Warmer needs a client with a cache that tracks accesses")
+        if not hasattr(manifest, '__iter__') or isinstance(manifest, str):
+            with open(manifest) as f:
+                manifest = json.load(f)
+        for entry in manifest:
+            if entry['endpoint'] not in _REQUESTS:
+                raise ValueError(
+                    "Unknown domain endpoint: {0}".format(entry['endpoint']))
+        self.client = client
+        self.manifest = manifest
+        self.window = window
+        self.rate = rate
+        self.budget = budget
+        self.ttl = ttl
+        self.workers = workers
+        self._jobs = []
+        for entry in manifest:
+            request = _REQUESTS[entry['endpoint']]
+            for domain in entry['domains']:
+                url, params = request(
+                    client, domain, **entry.get('params', {}))
+                self._jobs.append(
+                    (entry['endpoint'], domain, url, params,
+                     _cache_key(url, params)))
+
+    def jobs(self):
+        counts = self.client.cache.access_counts(
+            job[4] for job in self._jobs)
+        jobs = sorted(self._jobs, key=lambda job: -counts[job[4]])
+        return jobs[:self.budget]
+
+    def run(self):
+        client, cache = self.client, self.client.cache
+        jobs = self.jobs()
+        interval = self.window / len(jobs) if jobs else 0
+        if self.rate:
+            interval = max(interval, 1.0 / self.rate)
+        start = time.monotonic()
+
+        def fetch(item):
+            wait = start + item[0] * interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            _, _, url, params, key = item[1]
+            text = client._fetch(url, params)
+            cache.set(key, text, self.ttl or cache.ttl_for(url))
+
+        errors = []
+        for (_, job), result in client._fan_out(
+                fetch, enumerate(jobs), self.workers):
+            if isinstance(result, Exception):
+                errors.append((job[:2], result))
+        cache.decay_accesses()
+        return errors
+
+
+class _SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = fn(*args)
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
+
+
+def _retry_after(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+
+class RateLimiter(object):
+
+    def __init__(self, rate, burst=1, concurrency=None, adaptive=False,
+                 min_rate=None, max_retries=5):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = min_rate or self.max_rate / 64
+        self.burst = burst
+        self.max_concurrency = concurrency
+        self.concurrency = concurrency
+        self.adaptive = adaptive
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._cond = threading.Condition()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if end is not None and now >= end:
+                    return False
+                self._refill(now)
+                wait = self._paused_until - now
+                if wait <= 0:
+                    if (self.concurrency is not None and
+                            self.in_flight >= self.concurrency):
+                        wait = None
+                    elif self._tokens >= 1:
+                        self._tokens -= 1
+                        self.in_flight += 1
+                        return True
+                    else:
+                        wait = (1 - self._tokens) / self.rate
+                if end is not None:
+                    if wait is None:
+                        wait = end - now
+                    elif now + wait > end:
+                        return False
+                self._cond.wait(wait)
+
+    def release(self, throttled=False, retry_after=None):
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._tokens = 0.0
+                if retry_after:
+                    self._paused_until = max(
+                        self._paused_until, time.monotonic() + retry_after)
+                if self.adaptive:
+                    self.rate = max(self.min_rate, self.rate / 2)
+                    if self.concurrency is not None:
+                        self.concurrency = max(1, self.concurrency // 2)
+            elif self.adaptive:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+                if (self.concurrency is not None and
+                        self.concurrency < self.max_concurrency):
+                    self.concurrency += 1
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+
+class _Writer(object):
+
+    schemaless = False
+
+    def __init__(self, path, batch_size=1000, schema=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.schema = schema
+        self._batch = []
+
+    def write(self, row):
+        self.write_rows([row])
+
+    def write_rows(self, rows):
+        self.check(rows)
+        self._batch.extend(rows)
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+
+    def check(self, rows):
+        if self.schemaless or not rows:
+            return
+        if self.schema is None:
+            fields = collections.OrderedDict()
+            for row in rows:
+                fields.update(dict.fromkeys(row))
+            self.schema = tuple((field, None) for field in fields)
+        unknown = set().union(*rows).difference(self.fields)
+        if unknown:
+            raise ValueError("Rows have fields outside the export schema: "
+                             "{0}".format(', '.join(sorted(unknown))))
+
+    @property
+    def fields(self):
+        return [field for field, _ in self.schema]
+
+    def flush(self):
+        if self._batch:
+            self._write_batch(self._batch)
+            self._batch = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._close()
+
+    def _write_batch(self, rows):
+        raise NotImplementedError
+
+    def _close(self):
+        raise NotImplementedError
+
+
+class NDJSONWriter(_Writer):
+
+    schemaless = True
+
+    def __init__(self, path, batch_size=1000, schema=None):
+        _Writer.__init__(self, path, batch_size, schema)
+        self._owned = not hasattr(path, 'write')
+        self._file = open(path, 'w') if self._owned else path
+
+    def _write_batch(self, rows):
+        self._file.write(''.join(json.dumps(row) + '\n' for row in rows))
+        self._file.flush()
+
+    def _close(self):
+        if self._owned:
+            self._file.close()
+
+
+class CSVWriter(_Writer):
+
+    def __init__(self, path, batch_size=1000, schema=None):
+        _Writer.__init__(self, path, batch_size, schema)
+        self._file = open(path, 'w', newline='')
+        self._writer = None
+
+    def _write_batch(self, rows):
+        if self._writer is None:
+            self._writer = csv.DictWriter(self._file, self.fields)
+            self._writer.writeheader()
+        self._writer.writerows(rows)
+
+    def _close(self):
+        self._file.close()
+
+
+class ParquetWriter(_Writer):
+
+    def __init__(self, path, batch_size=1000, schema=None):
+        import pyarrow
+        import pyarrow.parquet
+        _Writer.__init__(self, path, batch_size, schema)
+        self._pyarrow = pyarrow
+        self._parquet = pyarrow.parquet
+        self._writer = None
+
+    def _write_batch(self, rows):
+        pyarrow = self._pyarrow
+        if self._writer is None:
+            inferred = pyarrow.Table.from_pylist(rows).schema
+            self._writer = self._parquet.ParquetWriter(
+                self.path, pyarrow.schema([
+                    (field, self._type(field, kind, inferred))
+                    for field, kind in self.schema]))
+        columns = dict((field, [row.get(field) for row in rows])
+                       for field in self._writer.schema.names)
+        self._writer.write_table(pyarrow.Table.from_pydict(columns).cast(
+            self._writer.schema))
+
+    def _type(self, field, kind, inferred):
+        if kind is not None:
+            return self._pyarrow.type_for_alias(kind)
+        kind = inferred.field(field).type
+        return self._pyarrow.string() if kind == self._pyarrow.null() else kind
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+_WRITERS = {
+    'ndjson': NDJSONWriter,
+    'csv': CSVWriter,
+    'parquet': ParquetWriter,
+}
+
+
+_TIME_SERIES_SCHEMA = (
+    ('domain', 'string'), ('date', 'string'), ('value', 'double'))
+
+
+def _row(domain, value):
+    row = {'domain': domain}
+    if isinstance(value, dict):
+        row.update(value)
+    else:
+        row['value'] = value
+    return row
+
+
+_CHECKPOINT_LINE = 21
+
+
+class Checkpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        self._torn = False
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for line in f:
+                    self._torn = not line.endswith(b'\n')
+                    if not self._torn and len(line) == _CHECKPOINT_LINE:
+                        self._done.add(line[:-1].decode('ascii'))
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+
+    @staticmethod
+    def key(endpoint, domain, params):
+        raw = json.dumps([endpoint, domain, sorted(params.items())])
+        return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:20]
+
+    def __contains__(self, key):
+        return key in self._done
+
+    def __len__(self):
+        return len(self._done)
+
+    def add(self, key):
+        with self._lock:
+            if key not in self._done:
+                self._done.add(key)
+                line = (key + '\n').encode('ascii')
+                if self._torn:
+                    line, self._torn = b'\n' + line, False
+                os.write(self._fd, line)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def _record_response(event, response, elapsed):
+    server = response.elapsed.total_seconds()
+    event['status'] = response.status_code
+    event['request'] = elapsed
+    event['server'] = server
+    event['transfer'] = max(0.0, elapsed - server)
+
+
+_LATENCY_BUCKETS = tuple(0.001 * 2 ** (i / 4.0) for i in range(64))
+
+
+class LatencyHistogram(object):
+
+    def __init__(self, buckets=_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q / 100.0 * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (
+                    (rank - seen) / count)
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics(object):
+
+    def __init__(self, buckets=_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.latency = {}
+        self.errors = collections.Counter()
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        endpoint = event['endpoint']
+        with self._lock:
+            histogram = self.latency.get(endpoint)
+            if histogram is None:
+                histogram = self.latency[endpoint] = LatencyHistogram(
+                    self.buckets)
+            histogram.observe(event['total'])
+            if event['error'] is not None:
+                self.errors[endpoint] += 1
+
+    def summary(self):
+        with self._lock:
+            return dict(
+                (endpoint, {
+                    'count': h.count,
+                    'errors': self.errors[endpoint],
+                    'p50': h.percentile(50),
+                    'p95': h.percentile(95),
+                    'p99': h.percentile(99),
+                })
+                for endpoint, h in self.latency.items())
+
+    def prometheus(self):
+        name = 'similarweb_request_duration_seconds'
+        lines = ['# TYPE {0} histogram'.format(name)]
+        with self._lock:
+            for endpoint in sorted(self.latency):
+                h = self.latency[endpoint]
+                cumulative = 0
+                bounds = ['{0:g}'.format(b) for b in h.buckets] + ['+Inf']
+                for bound, count in zip(bounds, h.counts):
+                    cumulative += count
+                    lines.append('{0}_bucket{{endpoint="{1}",le="{2}"}} {3}'
+                                 .format(name, endpoint, bound, cumulative))
+                lines.append('{0}_sum{{endpoint="{1}"}} {2!r}'.format(
+                    name, endpoint, h.sum))
+                lines.append('{0}_count{{endpoint="{1}"}} {2}'.format(
+                    name, endpoint, h.count))
+            lines.append('# TYPE similarweb_request_errors_total counter')
+            for endpoint in sorted(self.errors):
+                lines.append(
+                    'similarweb_request_errors_total{{endpoint="{0}"}} {1}'
+                    .format(endpoint, self.errors[endpoint]))
+        return '\n'.join(lines) + '\n'
+
+
+class KeyPool(object):
+
+    def __init__(self, keys, strategy='round_robin', quotas=None,
+                 cooldown=60):
+        if strategy not in ('round_robin', 'quota'):
+            raise ValueError("Unknown key strategy: {0}".format(strategy))
+        self.keys = list(keys)
+        self.strategy = strategy
+        self.remaining = dict(quotas or ())
+        self.cooldown = cooldown
+        self._disabled = {}
+        self._cycle = itertools.cycle(self.keys)
+        self._lock = threading.Lock()
+
+    def _available(self, key, now):
+        return self._disabled.get(key, 0) <= now
+
+    def next(self):
+        with self._lock:
+            now = time.monotonic()
+            if self.strategy == 'quota':
+                available = [k for k in self.keys if self._available(k, now)]
+                key = None
+                if available:
+                    key = max(
+                        available, key=lambda k: self.remaining.get(k, 0))
+            else:
+                key = next((k for k in itertools.islice(
+                    self._cycle, len(self.keys))
+                    if self._available(k, now)), None)
+            if key is None:
+                raise QuotaError("No API key is currently available")
+            if key in self.remaining:
+                self.remaining[key] -= 1
+            return key
+
+    def disable(self, key, seconds=None):
+        if seconds is None:
+            seconds = self.cooldown
+        with self._lock:
+            self._disabled[key] = time.monotonic() + seconds
+
+
+class RecordingTransport(object):
+
+    def __init__(self, path, transport=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.transport = transport or make_session()
+        self._lock = threading.Lock()
+        self._bodies = open(os.path.join(path, 'bodies.bin'), 'ab')
+        self._index = open(os.path.join(path, 'index.ndjson'), 'a')
+
+    def get(self, url, params=None, timeout=None):
+        r = self.transport.get(url=url, params=params, timeout=timeout)
+        entry = {
+            'key': _cache_key(url, params or {}),
+            'status': r.status_code,
+            'headers': dict(
+                (k, v) for k, v in r.headers.items()
+                if k.lower() in ('content-type', 'retry-after')),
+            'elapsed': r.elapsed.total_seconds(),
+            'length': len(r.content),
+        }
+        with self._lock:
+            entry['offset'] = self._bodies.tell()
+            self._bodies.write(r.content)
+            self._bodies.flush()
+            self._index.write(json.dumps(entry) + '\n')
+            self._index.flush()
+        return r
+
+    def close(self):
+        self._bodies.close()
+        self._index.close()
+
+
+class ReplayTransport(object):
+
+    def __init__(self, path, latency=0, jitter=0, error_rate=0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._index = {}
+        with open(os.path.join(path, 'index.ndjson')) as f:
+            for line in f:
+                entry = json.loads(line)
+                self._index[entry['key']] = entry
+        with open(os.path.join(path, 'bodies.bin'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size:
+                self._bodies = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._bodies = b''
+
+    def get(self, url, params=None, timeout=None):
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+        if delay:
+            time.sleep(delay)
+        r = requests.Response()
+        r.url = url
+        r.encoding = 'utf-8'
+        r.elapsed = datetime.timedelta(seconds=delay)
+        entry = self._index.get(_cache_key(url, params or {}))
+        if failed:
+            r.status_code, r._content = 503, b'Simulated failure'
+        elif entry is None:
+            r.status_code, r._content = 404, b'Not recorded'
+        else:
+            offset = entry['offset']
+            r.status_code = entry['status']
+            r.headers.update(entry['headers'])
+            r._content = bytes(
+                self._bodies[offset:offset + entry['length']])
+        return r
+
+    def __len__(self):
+        return len(self._index)
+
+
+def _process_context():
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context(
+        'forkserver' if 'forkserver' in methods else 'spawn')
+
+
+def _decode_and_transform(transform, content):
+    return transform(_json_loads(content))
+
+
+_NEIGHBOR_KEYS = ('Url', 'Site', 'Domain')
+
+
+def _neighbors(res):
+    values = res.values() if isinstance(res, dict) else [res]
+    for value in values:
+        if not isinstance(value, list):
+            continue
+        for item in value:
+            score = None
+            if isinstance(item, dict):
+                score = item.get('Score', item.get('Value'))
+                item = next(
+                    (item[k] for k in _NEIGHBOR_KEYS if item.get(k)), None)
+            if item:
+                yield item.strip().lower(), score
+        return
+
+
+def _completed(pending, futures):
+    for future in futures:
+        domain = pending.pop(future)
+        try:
+            yield domain, future.result()
+        except Exception as e:
+            yield domain, e
+
+
+def _imap_unordered(executor, fn, items, window):
+    pending = {}
+    items = iter(items)
+    for item in itertools.islice(items, window):
+        pending[executor.submit(fn, item)] = item
+    while pending:
+        done, _ = concurrent.futures.wait(
+            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            item = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                result = e
+            for next_item in itertools.islice(items, 1):
+                pending[executor.submit(fn, next_item)] = next_item
+            yield item, result
+
+
+def _full_pages(results):
+    page_size = None
+    try:
+        for records in results:
+            if not records:
+                return
+            yield records
+            if page_size is None:
+                page_size = len(records)
+            elif len(records) < page_size:
+                return
+    finally:
+        results.close()
+
+
+def _prefetched(fetch, prefetch):
+    pages = itertools.count(1)
+    with concurrent.futures.ThreadPoolExecutor(prefetch) as executor:
+        pending = collections.deque(
+            executor.submit(fetch, page)
+            for page in itertools.islice(pages, prefetch + 1))
+        try:
+            while True:
+                yield pending.popleft().result()
+                pending.append(executor.submit(fetch, next(pages)))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def _paginate(fetch, prefetch):
+    if prefetch:
+        return _full_pages(_prefetched(fetch, prefetch))
+    return _full_pages(fetch(page) for page in itertools.count(1))
 
 
 class Client(object):
 
-    def __init__(self, user_key, use_https=True):
+    def __init__(self, user_key, use_https=True, session=None, pool_size=10,
+                 keep_alive=True, timeout=None, host=_API_HOST, cache=None,
+                 rate_limiter=None, retries=0, backoff=0.5, max_backoff=30,
+                 deadline=None, coalesce=False, json_loads=None,
+                 hooks=None, transport=None):
         protocol = 'http'
         if use_https:
             protocol = 'https'
-        self.api_base_url_site = protocol + "://" + _API_BASE_URL_SITE
-        self.api_base_url = protocol + "://" + _API_BASE_URL
-        self.user_key = user_key
+        self.api_base_url_site = protocol + "://" + host + _API_BASE_URL_SITE
+        self.api_base_url = protocol + "://" + host + _API_BASE_URL
+        if isinstance(user_key, KeyPool):
+            self.key_pool = user_key
+        elif isinstance(user_key, (list, tuple)):
+            self.key_pool = KeyPool(user_key)
+        else:
+            self.key_pool = None
+        self.user_key = user_key if self.key_pool is None else None
+        self._site_prefix = protocol + "://" + host + _API_SITE_PATH
+        self._top_sites_url = self.api_base_url.format(
+            version='v1', endpoint='topsites')
+        self._static_params = {'format': 'JSON'}
+        if self.key_pool is None:
+            self._static_params['userkey'] = user_key
+        if session is None:
+            session = make_session(pool_size, keep_alive)
+        self.session = session
+        self.transport = transport or session
+        self.timeout = timeout
+        self.cache = cache
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self._flights = _SingleFlight() if coalesce else None
+        self.json_loads = json_loads or _json_loads
+        self.hooks = list(hooks or ())
+
+    def _base_params(self):
+        return self._static_params.copy()
 
     def _get_simple_params(self):
-        params = {
-            'format': 'JSON',
-            'userkey': self.user_key
-        }
-        return params
+        return self._base_params()
 
     def _get_granularity_params(self, start, end, granularity, main_domain):
-        params = {
-            'gr': granularity,
-            'start': start,
-            'end': end,
-            'md': main_domain,
-            'format': 'JSON',
-            'userkey': self.user_key
-        }
+        params = self._base_params()
+        params['gr'] = granularity
+        params['start'] = start
+        params['end'] = end
+        params['md'] = main_domain
         return params
 
     def _get_page_params(self, start, end, page, main_domain):
-        params = {
-            'page': page,
-            'start': start,
-            'end': end,
-            'md': main_domain,
-            'format': 'JSON',
-            'userkey': self.user_key
-        }
+        params = self._base_params()
+        params['page'] = page
+        params['start'] = start
+        params['end'] = end
+        params['md'] = main_domain
         return params
 
-    def _http_get(self, url, params):
-        r = requests.get(url=url, params=params)
-        if r.status_code != 200:
-            raise Exception("HTTP {0} ".format(r.status_code) + r.text)
-        return r.text
+    def _http_get(self, url, params, event=None):
+        if self.cache is None and self._flights is None:
+            return self._fetch(url, params, event)
+        key = _cache_key(url, params)
+        if self.cache is not None:
+            text = self.cache.get(key)
+            if text is not None:
+                if event is not None:
+                    event['cached'] = True
+                return text
+        if self._flights is None:
+            return self._fetch_and_store(key, url, params, event)
+        return self._flights.do(
+            key, self._fetch_and_store, key, url, params, event)
 
-    def visits(self, domain, start, end, granularity, main_domain=False):
-        params = self._get_granularity_params(
-            start, end, granularity, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='visits'), params=params))
+    def _get_json(self, url, params, endpoint):
+        if not self.hooks:
+            return self.json_loads(self._http_get(url=url, params=params))
+        event = {
+            'endpoint': endpoint,
+            'url': url,
+            'status': None,
+            'bytes': 0,
+            'retries': 0,
+            'cached': False,
+            'error': None,
+        }
+        start = time.perf_counter()
+        try:
+            content = self._http_get(url, params, event)
+            event['bytes'] = len(content)
+            decode_start = time.perf_counter()
+            res = self.json_loads(content)
+            event['decode'] = time.perf_counter() - decode_start
+            return res
+        except Exception as e:
+            event['error'] = e
+            raise
+        finally:
+            event['total'] = time.perf_counter() - start
+            for hook in self.hooks:
+                hook(event)
 
-    def traffic(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='traffic'), params=params))
+    def _fetch_and_store(self, key, url, params, event=None):
+        text = self._fetch(url, params, event)
+        if self.cache is not None:
+            self.cache.set(key, text, self.cache.ttl_for(url))
+        return text
 
-    def page_views(self, domain, start, end, granularity, main_domain=False):
-        params = self._get_granularity_params(
-            start, end, granularity, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='pageviews'), params=params))
+    def _fetch(self, url, params, event=None):
+        limiter = self.rate_limiter
+        pool = self.key_pool
+        deadline = None
+        if self.deadline is not None:
+            deadline = time.monotonic() + self.deadline
+        if pool is not None:
+            params = dict(params, userkey=pool.next())
+        attempt = throttled = rotated = 0
+        error = None
+        while True:
+            delay = None
+            if event is not None:
+                event['retries'] = attempt + throttled + rotated
+            try:
+                start = time.perf_counter()
+                r = self._send(url, params, deadline)
+                if r is None:
+                    raise error or RequestTimeoutError(
+                        'Deadline exceeded before the request was sent')
+                if event is not None:
+                    _record_response(event, r, time.perf_counter() - start)
+                if r.status_code == 200:
+                    return r.content
+                error, delay = _http_error(r), _retry_after(r)
+            except requests.exceptions.Timeout as e:
+                error = RequestTimeoutError(str(e))
+            except (requests.exceptions.ConnectionError,
+                    requests.exceptions.ChunkedEncodingError,
+                    requests.exceptions.ContentDecodingError) as e:
+                error = ServerError(str(e))
+            except requests.exceptions.RequestException as e:
+                error = SimilarWebError(str(e))
+            if (pool is not None and
+                    isinstance(error, (AuthError, QuotaError)) and
+                    rotated < len(pool.keys) - 1):
+                pool.disable(params['userkey'], delay)
+                params['userkey'] = pool.next()
+                rotated += 1
+                if deadline is not None and time.monotonic() >= deadline:
+                    raise error
+                continue
+            if (limiter is not None and
+                    error.status_code in _THROTTLE_STATUS and
+                    throttled < limiter.max_retries):
+                sleep = 0 if delay is not None else self._backoff(throttled)
+                if (deadline is not None and
+                        time.monotonic() + (delay or sleep) >= deadline):
+                    raise error
+                throttled += 1
+                time.sleep(sleep)
+                continue
+            if not error.retryable or attempt >= self.retries:
+                raise error
+            if delay is None:
+                delay = self._backoff(attempt)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                raise error
+            attempt += 1
+            time.sleep(delay)
 
-    def visit_duration(
-            self, domain, start, end, granularity, main_domain=False):
-        params = self._get_granularity_params(
-            start, end, granularity, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='visitduration'), params=params))
+    def _backoff(self, attempt):
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
 
-    def bounce_rate(self, domain, start, end, granularity, main_domain=False):
-        params = self._get_granularity_params(
-            start, end, granularity, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='bouncerate'), params=params))
+    def _send(self, url, params, deadline):
+        limiter = self.rate_limiter
+        if limiter is not None and not limiter.acquire(
+                None if deadline is None else deadline - time.monotonic()):
+            return None
+        timeout = self.timeout
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                if limiter is not None:
+                    limiter.cancel()
+                return None
+            timeout = remaining if timeout is None else min(
+                timeout, remaining)
+        if limiter is None:
+            return self.transport.get(url=url, params=params, timeout=timeout)
+        throttled, retry_after = True, None
+        try:
+            r = self.transport.get(url=url, params=params, timeout=timeout)
+            throttled = r.status_code in _THROTTLE_STATUS
+            if throttled:
+                retry_after = _retry_after(r)
+            return r
+        finally:
+            limiter.release(throttled, retry_after)
 
-    def similar_sites(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='similarsites'), params=params))
+    def _check_domain_endpoint(self, endpoint):
+        if endpoint not in _ENDPOINT_METHODS or endpoint == 'top_sites':
+            raise ValueError("Unknown domain endpoint: {0}".format(endpoint))
 
-    def also_visited(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='alsovisited'), params=params))
+    def _fan_out(self, fn, domains, workers):
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for domain, result in _imap_unordered(
+                    executor, fn, domains, workers * 2):
+                yield domain, result
 
-    def tags(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='tags'), params=params))
+    def bulk(self, endpoint, domains, workers=8, checkpoint=None, **kwargs):
+        self._check_domain_endpoint(endpoint)
+        method = functools.partial(getattr(self, endpoint), **kwargs)
+        if checkpoint is None:
+            return self._fan_out(method, domains, workers)
+        return self._checkpointed(
+            checkpoint, endpoint, method, domains, workers, kwargs)
 
-    def category(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='category'), params=params))
+    def _checkpointed(
+            self, checkpoint, endpoint, method, domains, workers, kwargs):
+        pending = (
+            domain for domain in domains
+            if checkpoint.key(endpoint, domain, kwargs) not in checkpoint)
+        for domain, result in self._fan_out(method, pending, workers):
+            yield domain, result
+            if not isinstance(result, Exception):
+                checkpoint.add(checkpoint.key(endpoint, domain, kwargs))
 
-    def category_rank(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='categoryrank'), params=params))
+    def compare(self, domains, metrics, start, end, granularity,
+                main_domain=False, workers=8):
+        for metric in metrics:
+            if metric not in _GRANULARITY_ENDPOINTS:
+                raise ValueError(
+                    "Unknown time-series metric: {0}".format(metric))
+        keys = [(domain, metric) for domain in domains for metric in metrics]
+
+        def fetch(key):
+            return getattr(self, key[1])(
+                key[0], start, end, granularity, main_domain, as_series=True)
+
+        fetched, errors = {}, {}
+        for key, result in self._fan_out(fetch, keys, workers):
+            if isinstance(result, Exception):
+                errors[key] = result
+            else:
+                fetched[key] = result
+        empty = TimeSeries(array.array('q'), array.array('d'))
+        series = collections.OrderedDict(
+            (key, fetched.get(key, empty)) for key in keys)
+        return ComparisonTable.from_series(series, errors)
+
+    def fetch_incremental(self, store, metric, domain, start, end,
+                          granularity, main_domain=False, mutable_months=1,
+                          today=None):
+        if metric not in _GRANULARITY_ENDPOINTS:
+            raise ValueError("Unknown time-series metric: {0}".format(metric))
+        key = (domain, metric, granularity, int(bool(main_domain)))
+        today = today or datetime.date.today()
+        mutable = today.year * 12 + today.month - 1 - mutable_months
+        held = store.months(key)
+        missing = [
+            month for month in range(
+                _month_index(start), _month_index(end) + 1)
+            if month not in held or month >= mutable]
+        method = getattr(self, metric)
+        for _, run in itertools.groupby(
+                enumerate(missing), lambda item: item[1] - item[0]):
+            months = [month for _, month in run]
+            series = method(
+                domain, _month_string(months[0]), _month_string(months[-1]),
+                granularity, main_domain, as_series=True)
+            store.put(key, months, series)
+        return store.get(key, start, end)
+
+    def process(self, endpoint, domains, transform, processes=None,
+                workers=8, **kwargs):
+        if endpoint not in _REQUESTS:
+            raise ValueError("Unknown domain endpoint: {0}".format(endpoint))
+        return self._process(
+            _REQUESTS[endpoint], domains, transform, processes, workers,
+            kwargs)
+
+    def _process(self, request, domains, transform, processes, workers,
+                 kwargs):
+        def fetch(domain):
+            return self._http_get(*request(self, domain, **kwargs))
+
+        limit = (processes or os.cpu_count() or 1) * 4
+        with concurrent.futures.ProcessPoolExecutor(
+                processes, mp_context=_process_context()) as pool:
+            pending = {}
+            for domain, result in self._fan_out(fetch, domains, workers):
+                if isinstance(result, Exception):
+                    yield domain, result
+                    continue
+                pending[pool.submit(
+                    _decode_and_transform, transform, result)] = domain
+                if len(pending) < limit:
+                    done = [f for f in pending if f.done()]
+                else:
+                    done, _ = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for item in _completed(pending, done):
+                    yield item
+            for item in _completed(pending, list(pending)):
+                yield item
+
+    def crawl(self, seeds, endpoints=('similar_sites',), depth=1,
+              max_nodes=None, workers=8):
+        for endpoint in endpoints:
+            self._check_domain_endpoint(endpoint)
+        return self._crawl(seeds, endpoints, depth, max_nodes, workers)
+
+    def _crawl(self, seeds, endpoints, depth, max_nodes, workers):
+        frontier = []
+        visited = set()
+        for seed in seeds:
+            seed = seed.strip().lower()
+            if seed not in visited:
+                visited.add(seed)
+                frontier.append(seed)
+        fetched = 0
+        for _ in range(depth):
+            if max_nodes is not None:
+                frontier = frontier[:max(0, max_nodes - fetched)]
+            if not frontier:
+                return
+            fetched += len(frontier)
+            jobs = [(domain, endpoint)
+                    for domain in frontier for endpoint in endpoints]
+            frontier = []
+            for (domain, endpoint), result in self._fan_out(
+                    lambda job: getattr(self, job[1])(job[0]), jobs, workers):
+                if isinstance(result, Exception):
+                    yield domain, None, endpoint, result
+                    continue
+                for neighbor, score in _neighbors(result):
+                    yield domain, neighbor, endpoint, score
+                    if neighbor not in visited:
+                        visited.add(neighbor)
+                        frontier.append(neighbor)
+
+    def _rows(self, endpoint, domain, kwargs):
+        if endpoint in _PAGE_ENDPOINTS:
+            for records in self._pages(
+                    getattr(self, endpoint), domain, **kwargs):
+                yield [_row(domain, record) for record in records]
+            return
+        res = getattr(self, endpoint)(domain, **kwargs)
+        if endpoint in _GRANULARITY_ENDPOINTS:
+            yield [
+                {'domain': domain, 'date': point['Date'],
+                 'value': point['Value']}
+                for point in res.get('Values') or ()]
+        else:
+            yield [_row(domain, res)]
+
+    def export(self, endpoint, domains, path, format='ndjson', workers=8,
+               batch_size=1000, **kwargs):
+        self._check_domain_endpoint(endpoint)
+        if format not in _WRITERS:
+            raise ValueError("Unknown export format: {0}".format(format))
+        writer = _WRITERS[format](
+            path, batch_size,
+            _TIME_SERIES_SCHEMA if endpoint in _GRANULARITY_ENDPOINTS
+            else None)
+        lock = threading.Lock()
+        rows = 0
+
+        def write(domain):
+            nonlocal rows
+            for chunk in self._rows(endpoint, domain, kwargs):
+                with lock:
+                    writer.write_rows(chunk)
+                    rows += len(chunk)
+
+        errors = []
+        try:
+            for domain, result in self._fan_out(write, domains, workers):
+                if isinstance(result, Exception):
+                    errors.append((domain, result))
+        finally:
+            writer.close()
+        return rows, errors
+
+    def _iter_pages(self, method, domain, start, end, main_domain, prefetch):
+        return itertools.chain.from_iterable(
+            self._pages(method, domain, start, end, main_domain, prefetch))
+
+    def _pages(self, method, domain, start, end, main_domain=False,
+               prefetch=0):
+        def fetch(page):
+            return method(domain, start, end, page, main_domain).get('Data')
+        return _paginate(fetch, prefetch)
 
     def adult(self, domain):
-        params = self._get_simple_params()
-        res = json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='category'), params=params))
-        return res['Category'] == 'Adult'
+        return self.category(domain)['Category'] == 'Adult'
 
     def top_sites(self, category=None, country=None):
         params = self._get_simple_params()
@@ -118,42 +1683,256 @@ class Client(object):
             params['Category'] = category
         if country:
             params['Country'] = country
-        return json.loads(self._http_get(
-            url=self.api_base_url.format(version='v1', endpoint='topsites'), params=params))
+        return self._get_json(self._top_sites_url, params, 'top_sites')
 
-    def social_referring_sites(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='socialreferringsites'), params=params))
+    def iter_organic_search(
+            self, domain, start, end, main_domain=False, prefetch=0):
+        return self._iter_pages(
+            self.organic_search, domain, start, end, main_domain, prefetch)
 
-    def organic_search(self, domain, start, end, page=1, main_domain=False):
-        params = self._get_page_params(start, end, page, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='orgsearch'), params=params))
+    def iter_paid_search(
+            self, domain, start, end, main_domain=False, prefetch=0):
+        return self._iter_pages(
+            self.paid_search, domain, start, end, main_domain, prefetch)
 
-    def paid_search(self, domain, start, end, page=1, main_domain=False):
-        params = self._get_page_params(start, end, page, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='paidsearch'), params=params))
+    def iter_referrals(
+            self, domain, start, end, main_domain=False, prefetch=0):
+        return self._iter_pages(
+            self.referrals, domain, start, end, main_domain, prefetch)
 
-    def leading_destination_sites(self, domain):
-        params = self._get_simple_params()
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v2', endpoint='leadingdestinationsites'), params=params))
+    def iter_organic_keyword_competitors(
+            self, domain, start, end, main_domain=False, prefetch=0):
+        return self._iter_pages(
+            self.organic_keyword_competitors, domain, start, end,
+            main_domain, prefetch)
 
-    def referrals(self, domain, start, end, page=1, main_domain=False):
-        params = self._get_page_params(start, end, page, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='referrals'), params=params))
+    def iter_paid_keyword_competitors(
+            self, domain, start, end, main_domain=False, prefetch=0):
+        return self._iter_pages(
+            self.paid_keyword_competitors, domain, start, end,
+            main_domain, prefetch)
 
-    def organic_keyword_competitors(
-            self, domain, start, end, page=1, main_domain=False):
-        params = self._get_page_params(start, end, page, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='orgkwcompetitor'), params=params))
 
-    def paid_keyword_competitors(
-            self, domain, start, end, page=1, main_domain=False):
+_ENDPOINTS = (
+    ('visits', 'v1', 'visits', 'granularity'),
+    ('traffic', 'v1', 'traffic', 'simple'),
+    ('page_views', 'v1', 'pageviews', 'granularity'),
+    ('visit_duration', 'v1', 'visitduration', 'granularity'),
+    ('bounce_rate', 'v1', 'bouncerate', 'granularity'),
+    ('similar_sites', 'v2', 'similarsites', 'simple'),
+    ('also_visited', 'v2', 'alsovisited', 'simple'),
+    ('tags', 'v2', 'tags', 'simple'),
+    ('category', 'v2', 'category', 'simple'),
+    ('category_rank', 'v2', 'categoryrank', 'simple'),
+    ('social_referring_sites', 'v1', 'socialreferringsites', 'simple'),
+    ('organic_search', 'v1', 'orgsearch', 'page'),
+    ('paid_search', 'v1', 'paidsearch', 'page'),
+    ('leading_destination_sites', 'v2', 'leadingdestinationsites', 'simple'),
+    ('referrals', 'v1', 'referrals', 'page'),
+    ('organic_keyword_competitors', 'v1', 'orgkwcompetitor', 'page'),
+    ('paid_keyword_competitors', 'v1', 'paidkwcompetitor', 'page'),
+)
+
+_ENDPOINT_METHODS = tuple(e[0] for e in _ENDPOINTS) + ('adult', 'top_sites')
+
+_API_ENDPOINTS = dict(((e[0], e[2]) for e in _ENDPOINTS), top_sites='topsites')
+
+_GRANULARITY_ENDPOINTS = tuple(
+    e[0] for e in _ENDPOINTS if e[3] == 'granularity')
+
+_PAGE_ENDPOINTS = tuple(e[0] for e in _ENDPOINTS if e[3] == 'page')
+
+
+def _simple_endpoint(name, suffix):
+    def request(self, domain):
+        return self._site_prefix + domain + suffix, self._get_simple_params()
+
+    def method(self, domain):
+        return self._get_json(*request(self, domain), name)
+    return method, request
+
+
+def _granularity_endpoint(name, suffix):
+    def request(self, domain, start, end, granularity, main_domain=False):
+        params = self._get_granularity_params(
+            start, end, granularity, main_domain)
+        return self._site_prefix + domain + suffix, params
+
+    def method(self, domain, start, end, granularity, main_domain=False,
+               as_series=False):
+        res = self._get_json(
+            *request(self, domain, start, end, granularity, main_domain),
+            name)
+        return TimeSeries.from_response(res) if as_series else res
+    return method, request
+
+
+def _page_endpoint(name, suffix):
+    def request(self, domain, start, end, page=1, main_domain=False):
         params = self._get_page_params(start, end, page, main_domain)
-        return json.loads(self._http_get(url=self.api_base_url_site.format(
-            domain=domain, version='v1', endpoint='paidkwcompetitor'), params=params))
+        return self._site_prefix + domain + suffix, params
+
+    def method(self, domain, start, end, page=1, main_domain=False,
+               fields=None):
+        res = self._get_json(
+            *request(self, domain, start, end, page, main_domain),
+            name)
+        if fields:
+            return ProjectedRecords.from_response(res, fields)
+        return res
+    return method, request
+
+
+_ENDPOINT_FACTORIES = {
+    'simple': _simple_endpoint,
+    'granularity': _granularity_endpoint,
+    'page': _page_endpoint,
+}
+
+_REQUESTS = {}
+
+for _name, _version, _endpoint, _kind in _ENDPOINTS:
+    _method, _REQUESTS[_name] = _ENDPOINT_FACTORIES[_kind](
+        _name, '/{0}/{1}'.format(_version, _endpoint))
+    _method.__name__ = _name
+    _method.__qualname__ = 'Client.' + _name
+    setattr(Client, _name, _method)
+
+
+def _async_endpoint(name):
+    @functools.wraps(getattr(Client, name))
+    async def method(self, *args, **kwargs):
+        return await self._call(getattr(self.client, name), *args, **kwargs)
+    return method
+
+
+class AsyncClient(object):
+
+    def __init__(self, user_key, use_https=True, concurrency=100, client=None,
+                 **kwargs):
+        if client is None:
+            kwargs.setdefault('pool_size', concurrency)
+            client = Client(user_key, use_https, **kwargs)
+        self.client = client
+        self.concurrency = concurrency
+        self._executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    async def _call(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(fn, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+
+for _name in _ENDPOINT_METHODS:
+    setattr(AsyncClient, _name, _async_endpoint(_name))
+
+
+def _read_domains(f):
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def _endpoint_kwargs(args):
+    if args.endpoint in _GRANULARITY_ENDPOINTS:
+        return {'start': args.start, 'end': args.end,
+                'granularity': args.granularity,
+                'main_domain': args.main_domain}
+    if args.endpoint in _PAGE_ENDPOINTS:
+        return {'start': args.start, 'end': args.end, 'page': args.page,
+                'main_domain': args.main_domain}
+    return {}
+
+
+def _fetch_command(args):
+    if args.endpoint in _GRANULARITY_ENDPOINTS + _PAGE_ENDPOINTS and not (
+            args.start and args.end):
+        sys.stderr.write('--start and --end are required for {0}\n'.format(
+            args.endpoint))
+        return 2
+    keys = args.user_key.split(',')
+    limiter = RateLimiter(args.rate, adaptive=True) if args.rate else None
+    client = Client(
+        keys if len(keys) > 1 else keys[0], pool_size=args.concurrency,
+        timeout=args.timeout, retries=args.retries, rate_limiter=limiter)
+    domains = sys.stdin if args.domains == '-' else open(args.domains)
+    out = sys.stdout if args.out == '-' else args.out
+    writer = NDJSONWriter(out, batch_size=args.batch_size)
+    done = errors = 0
+    start = last_report = time.time()
+    try:
+        for domain, result in client.bulk(
+                args.endpoint, _read_domains(domains),
+                workers=args.concurrency, **_endpoint_kwargs(args)):
+            done += 1
+            if isinstance(result, Exception):
+                errors += 1
+                writer.write({
+                    'domain': domain, 'error': str(result),
+                    'status': getattr(result, 'status_code', None)})
+            else:
+                writer.write({'domain': domain, 'result': result})
+            now = time.time()
+            if args.progress and now - last_report >= args.progress:
+                last_report = now
+                sys.stderr.write('{0} done, {1} errors, {2:.1f}/s\n'.format(
+                    done, errors, done / (now - start)))
+    finally:
+        writer.close()
+        if domains is not sys.stdin:
+            domains.close()
+    elapsed = max(time.time() - start, 1e-9)
+    sys.stderr.write('{0} done, {1} errors in {2:.1f}s ({3:.1f}/s)\n'.format(
+        done, errors, elapsed, done / elapsed))
+    return 1 if errors else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m similarweb')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    fetch = commands.add_parser(
+        'fetch', help='run one endpoint for every domain in a list')
+    fetch.add_argument(
+        '--user-key', default=os.environ.get('SIMILARWEB_USER_KEY'),
+        required='SIMILARWEB_USER_KEY' not in os.environ,
+        help='API key, or comma-separated keys (default: '
+             '$SIMILARWEB_USER_KEY)')
+    fetch.add_argument(
+        '--endpoint', required=True,
+        choices=[e for e in _ENDPOINT_METHODS if e != 'top_sites'])
+    fetch.add_argument(
+        '--domains', default='-',
+        help='file with one domain per line, or - for stdin')
+    fetch.add_argument('--start', help='first month, e.g. 1-2024')
+    fetch.add_argument('--end', help='last month, e.g. 6-2024')
+    fetch.add_argument('--granularity', default='monthly')
+    fetch.add_argument('--page', type=int, default=1)
+    fetch.add_argument('--main-domain', action='store_true')
+    fetch.add_argument('--concurrency', type=int, default=8)
+    fetch.add_argument('--rate', type=float,
+                       help='maximum requests per second')
+    fetch.add_argument('--retries', type=int, default=3)
+    fetch.add_argument('--timeout', type=float, default=60)
+    fetch.add_argument('--out', default='-',
+                       help='NDJSON output file, or - for stdout')
+    fetch.add_argument('--batch-size', type=int, default=100)
+    fetch.add_argument('--progress', type=float, default=5,
+                       help='seconds between progress reports, 0 to disable')
+    fetch.set_defaults(run=_fetch_command)
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
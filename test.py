@@ -1,12 +1,78 @@
+import asyncio
 import copy
+import datetime
 import json
+import operator
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
+import requests
 import requests_mock
 
 import similarweb
 
 
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, headers, body = self.server.respond(self)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'Content-Length' not in headers:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, delay=0, body=None, responder=None):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), _StubHandler)
+        self.delay = delay
+        self.body = json.dumps(body or {'foo': 'bar'}).encode('utf-8')
+        self.responder = responder
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    def respond(self, handler):
+        with self.lock:
+            self.request_count += 1
+            count = self.request_count
+        if self.delay:
+            time.sleep(self.delay)
+        if self.responder is not None:
+            return self.responder(handler, count)
+        return 200, {'Content-Type': 'application/json'}, self.body
+
+    def client(self, cls=similarweb.Client, **kwargs):
+        host = '127.0.0.1:{0}'.format(self.server_address[1])
+        return cls('asd', use_https=False, host=host, **kwargs)
+
+    def __enter__(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
 class TestClient(unittest.TestCase):
 
     def setUp(self):
@@ -480,5 +546,966 @@ class TestClient(unittest.TestCase):
                         data['main_domain'])
         self.assertEquals(m.call_count, len(self.test_data))
 
+    def test_shared_session(self):
+        with requests_mock.mock() as m:
+            data = copy.deepcopy(self.test_data[0])
+            data['version'] = 'v1'
+            data['endpoint'] = 'traffic'
+            m.register_uri(
+                'GET',
+                self.api_base_url['site'].format(
+                    **data) + self.query_param['simple'].format(**data),
+                text=json.dumps(self.response_data))
+            session = similarweb.make_session(pool_size=4)
+            clients = [
+                similarweb.Client(
+                    user_key=self.user_key, session=session, timeout=5)
+                for _ in range(2)]
+            for c in clients:
+                self.assertIs(c.session, session)
+                res = c.traffic(data['domain'])
+                self.assertEqual(res, self.response_data)
+                self.assertEqual(m.last_request.timeout, 5)
+        self.assertEqual(m.call_count, len(clients))
+
+    def test_bulk(self):
+        with requests_mock.mock() as m:
+            domains = ['example{0}.com'.format(i) for i in range(10)]
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v1'
+                data['endpoint'] = 'visits'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['granularity'].format(**data),
+                    text=json.dumps(self.response_data),
+                    status_code=500 if i == 3 else 200)
+            c = similarweb.Client(user_key=self.user_key)
+            res = dict(c.bulk(
+                'visits', iter(domains), workers=3, start=data['start'],
+                end=data['end'], granularity=data['granularity'],
+                main_domain=data['main_domain']))
+        self.assertEqual(sorted(res), domains)
+        for i, domain in enumerate(domains):
+            if i == 3:
+                self.assertIsInstance(res[domain], Exception)
+            else:
+                self.assertEqual(res[domain], self.response_data)
+        self.assertEqual(m.call_count, len(domains))
+        with self.assertRaises(ValueError):
+            list(c.bulk('top_sites', domains))
+
+    def _register_category(self, m, domain='example.com'):
+        data = copy.deepcopy(self.test_data[0])
+        data['domain'] = domain
+        data['version'] = 'v2'
+        data['endpoint'] = 'category'
+        m.register_uri(
+            'GET',
+            self.api_base_url['site'].format(
+                **data) + self.query_param['simple'].format(**data),
+            text=json.dumps({'Category': 'Adult'}))
+
+    def test_memory_cache(self):
+        with requests_mock.mock() as m:
+            self._register_category(m)
+            self._register_category(m, 'example.org')
+            cache = similarweb.MemoryCache(maxsize=1)
+            c = similarweb.Client(user_key=self.user_key, cache=cache)
+            self.assertEqual(c.category('example.com'), {'Category': 'Adult'})
+            self.assertTrue(c.adult('example.com'))
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            c.category('example.org')
+            c.category('example.com')
+            self.assertEqual(m.call_count, 3)
+            self.assertEqual(len(cache), 1)
+            c = similarweb.Client(
+                user_key=self.user_key,
+                cache=similarweb.MemoryCache(ttl={'category': 0}))
+            c.category('example.com')
+            c.category('example.com')
+            self.assertEqual(m.call_count, 5)
+            self.assertEqual(
+                similarweb.MemoryCache(ttl={'similar_sites': 0}).ttl_for(
+                    c._site_prefix + 'example.com/v2/similarsites'), 0)
+            self.assertRaises(
+                ValueError, similarweb.MemoryCache, ttl={'similarsites': 0})
+
+    def test_warmer(self):
+        domains = ['example.com', 'example.org', 'example.net']
+        path = os.path.join(self._tempdir(), 'cache.db')
+        manifest = [{'endpoint': 'category', 'domains': domains}]
+        with requests_mock.mock() as m:
+            for domain in domains:
+                self._register_category(m, domain)
+            m.register_uri('GET', self._traffic_url(), text='{}')
+            serving = similarweb.Client(
+                user_key=self.user_key, cache=similarweb.SQLiteCache(
+                    path, ttl={'category': 0}, track_accesses=True))
+            serving.category('example.net')
+            serving.category('example.net')
+            serving.category('example.org')
+            serving.category('example.org')
+            serving.category('example.net')
+            serving.traffic('example.com')
+            c = similarweb.Client(
+                user_key=self.user_key, cache=similarweb.SQLiteCache(
+                    path, track_accesses=True))
+            warmer = similarweb.Warmer(
+                c, manifest, window=0.1, budget=2, ttl=60, workers=1)
+            self.assertEqual(
+                [job[1] for job in warmer.jobs()],
+                ['example.net', 'example.org'])
+            start = time.monotonic()
+            self.assertEqual(warmer.run(), [])
+            self.assertGreaterEqual(time.monotonic() - start, 0.05)
+            self.assertEqual(m.call_count, 8)
+            keys = [job[4] for job in warmer.jobs()]
+            self.assertEqual(
+                c.cache.access_counts(keys), dict.fromkeys(keys, 1))
+            serving.category('example.net')
+            serving.category('example.org')
+            self.assertEqual(m.call_count, 8)
+            self.assertRaises(
+                ValueError, similarweb.Warmer, c, [{'endpoint': 'foo'}])
+        self.assertRaises(
+            ValueError, similarweb.Warmer,
+            similarweb.Client(self.user_key, cache=similarweb.MemoryCache()),
+            manifest)
+
+        pool = similarweb.KeyPool(['key1'], strategy='quota', quotas={'key1': 5})
+        c = similarweb.Client(
+            pool, cache=similarweb.MemoryCache(track_accesses=True))
+        similarweb.Warmer(c, manifest).jobs()
+        self.assertEqual(pool.remaining, {'key1': 5})
+
+    def test_cache_key_encoding(self):
+        url = 'https://api.similarweb.com/v1/topsites'
+        self.assertNotEqual(
+            similarweb._cache_key(url, {'Category': 'a&Country=b'}),
+            similarweb._cache_key(url, {'Category': 'a', 'Country': 'b'}))
+        self.assertEqual(
+            similarweb._cache_key(url, {'b': 1, 'userkey': 'x', 'a': 'c d'}),
+            url + '?a=c+d&b=1')
+
+    def test_sqlite_cache(self):
+        path = os.path.join(self._tempdir(), 'cache.db')
+        with requests_mock.mock() as m:
+            self._register_category(m)
+            for key in ('asd', 'qwe'):
+                cache = similarweb.SQLiteCache(path)
+                c = similarweb.Client(user_key=key, cache=cache)
+                self.assertTrue(c.adult('example.com'))
+                cache.close()
+            self.assertEqual(m.call_count, 1)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+    def test_iter_referrals(self):
+        pages = {1: ['a', 'b'], 2: ['c', 'd'], 3: ['e']}
+        threads = set()
+
+        def page_body(page):
+            def body(request, context):
+                threads.add(threading.current_thread())
+                return json.dumps({'Data': pages.get(page, [])})
+            return body
+
+        for prefetch in (0, 2):
+            threads.clear()
+            with requests_mock.mock() as m:
+                for page in range(1, 6):
+                    data = copy.deepcopy(self.test_data[0])
+                    data['page'] = page
+                    data['version'] = 'v1'
+                    data['endpoint'] = 'referrals'
+                    m.register_uri(
+                        'GET',
+                        self.api_base_url['site'].format(
+                            **data) + self.query_param['page'].format(**data),
+                        text=page_body(page))
+                c = similarweb.Client(user_key=self.user_key)
+                res = list(c.iter_referrals(
+                    data['domain'], data['start'], data['end'],
+                    data['main_domain'], prefetch=prefetch))
+                self.assertEqual(res, ['a', 'b', 'c', 'd', 'e'])
+                if not prefetch:
+                    self.assertEqual(m.call_count, len(pages))
+                    self.assertEqual(threads, set([threading.current_thread()]))
+
+    def _tempdir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        return path
+
+    def _traffic_url(self):
+        data = copy.deepcopy(self.test_data[0])
+        data['version'] = 'v1'
+        data['endpoint'] = 'traffic'
+        return self.api_base_url['site'].format(
+            **data) + self.query_param['simple'].format(**data)
+
+    def test_typed_errors(self):
+        errors = [
+            ({'status_code': 401}, similarweb.AuthError),
+            ({'status_code': 403}, similarweb.AuthError),
+            ({'status_code': 404}, similarweb.NotFoundError),
+            ({'status_code': 429}, similarweb.QuotaError),
+            ({'status_code': 502}, similarweb.ServerError),
+            ({'status_code': 400}, similarweb.SimilarWebError),
+            ({'exc': requests.exceptions.ConnectTimeout},
+             similarweb.RequestTimeoutError),
+            ({'exc': requests.exceptions.ConnectionError},
+             similarweb.ServerError),
+        ]
+        c = similarweb.Client(user_key=self.user_key)
+        for response, cls in errors:
+            with requests_mock.mock() as m:
+                m.register_uri('GET', self._traffic_url(), **response)
+                with self.assertRaises(cls) as cm:
+                    c.traffic('example.com')
+                self.assertEqual(
+                    cm.exception.status_code, response.get('status_code'))
+
+    def test_retries(self):
+        with requests_mock.mock() as m:
+            m.register_uri('GET', self._traffic_url(), [
+                {'status_code': 503, 'text': 'unavailable'},
+                {'exc': requests.exceptions.ConnectionError},
+                {'text': json.dumps(self.response_data)},
+            ])
+            c = similarweb.Client(
+                user_key=self.user_key, retries=2, backoff=0.01)
+            self.assertEqual(c.traffic('example.com'), self.response_data)
+            self.assertEqual(m.call_count, 3)
+
+        with requests_mock.mock() as m:
+            m.register_uri('GET', self._traffic_url(), status_code=404)
+            with self.assertRaises(similarweb.NotFoundError):
+                c.traffic('example.com')
+            self.assertEqual(m.call_count, 1)
+
+        with requests_mock.mock() as m:
+            m.register_uri('GET', self._traffic_url(), status_code=500)
+            c = similarweb.Client(
+                user_key=self.user_key, retries=100, backoff=0.05,
+                deadline=0.2)
+            start = time.time()
+            with self.assertRaises(similarweb.ServerError):
+                c.traffic('example.com')
+            self.assertLess(time.time() - start, 0.5)
+
+    def test_retries_truncated_body(self):
+        def truncated(handler, count):
+            if count == 1:
+                return 200, {'Content-Length': '100',
+                             'Connection': 'close'}, b'{"foo": "b'
+            return 200, {}, json.dumps(self.response_data).encode('utf-8')
+
+        with _StubServer(responder=truncated) as server:
+            c = server.client(retries=3, backoff=0.01)
+            self.assertEqual(c.traffic('example.com'), self.response_data)
+            self.assertEqual(server.request_count, 2)
+            c = server.client()
+            server.responder = lambda handler, count: truncated(handler, 1)
+            with self.assertRaises(similarweb.ServerError):
+                c.traffic('example.com')
+
+    def test_deadline_with_rate_limiter(self):
+        for retry_after, calls in (('1', 1), ('0.1', None)):
+            with requests_mock.mock() as m:
+                m.register_uri(
+                    'GET', self._traffic_url(), status_code=429,
+                    headers={'Retry-After': retry_after})
+                c = similarweb.Client(
+                    user_key=self.user_key, deadline=0.3,
+                    rate_limiter=similarweb.RateLimiter(rate=100))
+                start = time.time()
+                with self.assertRaises(similarweb.QuotaError):
+                    c.traffic('example.com')
+                self.assertLess(time.time() - start, 0.5)
+                if calls is not None:
+                    self.assertEqual(m.call_count, calls)
+
+    def test_coalesce(self):
+        with _StubServer(delay=0.1) as server:
+            c = server.client(coalesce=True)
+            res = list(c.bulk('traffic', ['example.com'] * 8, workers=8))
+            self.assertEqual(server.request_count, 1)
+
+            async def fetch_all(ac):
+                return await asyncio.gather(
+                    *[ac.traffic('example.com') for _ in range(8)])
+
+            ac = similarweb.AsyncClient(None, client=c, concurrency=8)
+            res += [('example.com', r) for r in asyncio.run(fetch_all(ac))]
+            ac.close()
+            self.assertEqual(server.request_count, 2)
+        self.assertEqual(res, [('example.com', self.response_data)] * 16)
+
+    def test_json_loads(self):
+        payloads = []
+
+        def loads(payload):
+            payloads.append(payload)
+            return json.loads(payload)
+
+        with requests_mock.mock() as m:
+            m.register_uri(
+                'GET', self._traffic_url(),
+                text=json.dumps(self.response_data))
+            c = similarweb.Client(user_key=self.user_key, json_loads=loads)
+            self.assertEqual(c.traffic('example.com'), self.response_data)
+        self.assertEqual(
+            payloads, [json.dumps(self.response_data).encode('utf-8')])
+
+    def test_visits_as_series(self):
+        response = {
+            'Values': [
+                {'Date': '2013-09-01T00:00:00', 'Value': 10},
+                {'Date': '2013-09-02T00:00:00', 'Value': 12.5},
+                {'Date': '2013-09-03T00:00:00', 'Value': None},
+            ],
+            'Granularity': 'Daily',
+        }
+        with requests_mock.mock() as m:
+            data = copy.deepcopy(self.test_data[0])
+            data['version'] = 'v1'
+            data['endpoint'] = 'visits'
+            m.register_uri(
+                'GET',
+                self.api_base_url['site'].format(
+                    **data) + self.query_param['granularity'].format(**data),
+                text=json.dumps(response))
+            c = similarweb.Client(user_key=self.user_key)
+            res = c.visits(
+                data['domain'], data['start'], data['end'],
+                data['granularity'], data['main_domain'], as_series=True)
+        self.assertIsInstance(res, similarweb.TimeSeries)
+        self.assertEqual(res.granularity, 'Daily')
+        self.assertEqual(len(res), 3)
+        points = list(res)
+        self.assertEqual(points[0], (datetime.date(2013, 9, 1), 10.0))
+        self.assertEqual(points[1], (datetime.date(2013, 9, 2), 12.5))
+        self.assertNotEqual(points[2][1], points[2][1])
+
+    def test_compare(self):
+        responses = {
+            ('a.com', 'visits'): [('2013-09-01', 1), ('2013-10-01', 2)],
+            ('a.com', 'bouncerate'): [('2013-09-01', 0.5),
+                                      ('2013-10-01', 0.4)],
+            ('b.com', 'visits'): [('2013-10-01', 3)],
+        }
+        with requests_mock.mock() as m:
+            for domain in ('a.com', 'b.com'):
+                for endpoint in ('visits', 'bouncerate'):
+                    data = copy.deepcopy(self.test_data[0])
+                    data['domain'] = domain
+                    data['version'] = 'v1'
+                    data['endpoint'] = endpoint
+                    points = responses.get((domain, endpoint))
+                    m.register_uri(
+                        'GET',
+                        self.api_base_url['site'].format(
+                            **data) + self.query_param['granularity'].format(
+                                **data),
+                        text=json.dumps({'Values': [
+                            {'Date': d, 'Value': v} for d, v in points or ()]}),
+                        status_code=200 if points else 500)
+            c = similarweb.Client(user_key=self.user_key)
+            table = c.compare(
+                ['a.com', 'b.com'], ['visits', 'bounce_rate'],
+                data['start'], data['end'], data['granularity'],
+                data['main_domain'])
+        self.assertEqual(
+            [datetime.date.fromordinal(d) for d in table.dates],
+            [datetime.date(2013, 9, 1), datetime.date(2013, 10, 1)])
+        self.assertEqual(list(table.columns), [
+            ('a.com', 'visits'), ('a.com', 'bounce_rate'),
+            ('b.com', 'visits'), ('b.com', 'bounce_rate')])
+        self.assertEqual(list(table['a.com', 'visits']), [1, 2])
+        self.assertEqual(list(table['a.com', 'bounce_rate']), [0.5, 0.4])
+        b_visits = table['b.com', 'visits']
+        self.assertNotEqual(b_visits[0], b_visits[0])
+        self.assertEqual(b_visits[1], 3)
+        self.assertEqual(list(table.errors), [('b.com', 'bounce_rate')])
+        with self.assertRaises(ValueError):
+            c.compare(['a.com'], ['traffic'], '1-2013', '2-2013', 'daily')
+
+    def test_fetch_incremental(self):
+        def monthly_values(request, context):
+            start = similarweb._month_index(request.qs['start'][0])
+            end = similarweb._month_index(request.qs['end'][0])
+            return json.dumps({'Values': [
+                {'Date': '{0}-{1:02d}-01'.format(m // 12, m % 12 + 1),
+                 'Value': m}
+                for m in range(start, end + 1)]})
+
+        store = similarweb.TimeSeriesStore()
+        today = datetime.date(2013, 12, 15)
+        with requests_mock.mock() as m:
+            m.register_uri(
+                'GET',
+                'https://api.similarweb.com/Site/example.com/v1/visits',
+                text=monthly_values)
+            c = similarweb.Client(user_key=self.user_key)
+
+            def fetch(start, end):
+                return c.fetch_incremental(
+                    store, 'visits', 'example.com', start, end, 'monthly',
+                    today=today)
+
+            self.assertEqual(len(fetch('1-2013', '12-2013')), 12)
+            self.assertEqual(m.call_count, 1)
+            res = fetch('1-2013', '12-2013')
+            self.assertEqual(m.call_count, 2)
+            self.assertEqual(
+                (m.last_request.qs['start'], m.last_request.qs['end']),
+                (['11-2013'], ['12-2013']))
+            self.assertEqual(
+                list(res.values), [2013 * 12 + i for i in range(12)])
+            res = fetch('1-2012', '12-2013')
+            self.assertEqual(m.call_count, 4)
+            self.assertEqual(len(res), 24)
+            self.assertEqual(
+                list(res.values), [2012 * 12 + i for i in range(24)])
+
+    def test_process(self):
+        domains = ['example{0}.com'.format(i) for i in range(6)]
+        with requests_mock.mock() as m:
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v1'
+                data['endpoint'] = 'referrals'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['page'].format(**data),
+                    text=json.dumps({'Data': [domain] * i}),
+                    status_code=404 if i == 0 else 200)
+            c = similarweb.Client(user_key=self.user_key)
+            res = dict(c.process(
+                'referrals', domains, operator.itemgetter('Data'),
+                processes=2, workers=3, start=data['start'], end=data['end'],
+                page=data['page'], main_domain=data['main_domain']))
+        self.assertEqual(sorted(res), domains)
+        self.assertIsInstance(res[domains[0]], similarweb.NotFoundError)
+        for i, domain in enumerate(domains[1:], 1):
+            self.assertEqual(res[domain], [domain] * i)
+        with self.assertRaises(ValueError):
+            c.process('adult', domains, len)
+
+    def test_crawl(self):
+        graph = {
+            'a.com': ['b.com', 'c.com'],
+            'b.com': ['a.com', 'd.com'],
+            'c.com': ['D.com'],
+            'd.com': ['e.com'],
+        }
+        with requests_mock.mock() as m:
+            for domain, neighbors in graph.items():
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v2'
+                data['endpoint'] = 'similarsites'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['simple'].format(**data),
+                    text=json.dumps({'SimilarSites': [
+                        {'Url': n, 'Score': 0.5} for n in neighbors]}))
+            c = similarweb.Client(user_key=self.user_key)
+            edges = list(c.crawl(['a.com'], depth=2, workers=2))
+            self.assertEqual(m.call_count, 3)
+            self.assertEqual(sorted((e[0], e[1]) for e in edges), [
+                ('a.com', 'b.com'), ('a.com', 'c.com'), ('b.com', 'a.com'),
+                ('b.com', 'd.com'), ('c.com', 'd.com')])
+            self.assertEqual(
+                set((e[2], e[3]) for e in edges),
+                set([('similar_sites', 0.5)]))
+            edges = list(c.crawl(['a.com'], depth=5, max_nodes=2))
+            self.assertEqual(m.call_count, 5)
+            self.assertEqual(len(edges), 4)
+        with self.assertRaises(ValueError):
+            c.crawl(['a.com'], endpoints=('top_sites',))
+
+    def test_snapshot(self):
+        with requests_mock.mock() as m:
+            m.register_uri(
+                'GET', 'https://api.similarweb.com/v1/topsites',
+                text=json.dumps({'TopSites': [
+                    {'Site': 'a.com'}, {'Site': 'b.com'}, {'Site': 'c.com'}]}))
+            for domain, rank in (('a.com', 1), ('b.com', 7)):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v2'
+                data['endpoint'] = 'categoryrank'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['simple'].format(**data),
+                    text=json.dumps({'Category': 'Sports', 'CategoryRank': rank}))
+            c = similarweb.Client(user_key=self.user_key)
+            snapshot = similarweb.Snapshot()
+            errors = snapshot.load(
+                c, top_sites=[('Sports', 'us')],
+                domains=['a.com', 'B.com', 'x.com'])
+            self.assertEqual(m.call_count, 4)
+            self.assertEqual([job for job, _ in errors],
+                             [('category_rank', 'x.com')])
+            self.assertEqual(
+                snapshot.top_sites('Sports', 'us'), ['a.com', 'b.com', 'c.com'])
+            self.assertEqual(snapshot.top_sites_rank('c.com', 'Sports', 'us'), 3)
+            self.assertEqual(snapshot.top_sites_rank('c.com', 'Sports'), None)
+            self.assertEqual(snapshot.category('b.com'), 'Sports')
+            self.assertEqual(snapshot.category_rank('b.com', 'Sports'), 7)
+            self.assertEqual(snapshot.category_rank('b.com', 'News'), None)
+            self.assertEqual(snapshot.stale(3600), ([], []))
+            self.assertEqual(
+                snapshot.stale(-1), ([('Sports', 'us')], ['a.com', 'b.com']))
+            snapshot.refresh(c, -1)
+            self.assertEqual(m.call_count, 7)
+
+    def test_projected_fields(self):
+        response = {
+            'Data': [
+                {'Site': 'a.com', 'Value': 0.5, 'Change': 0.1},
+                {'Site': 'b.com', 'Value': 0.25},
+            ],
+            'ResultsCount': 2,
+        }
+        with requests_mock.mock() as m:
+            data = copy.deepcopy(self.test_data[0])
+            data['version'] = 'v1'
+            data['endpoint'] = 'referrals'
+            m.register_uri(
+                'GET',
+                self.api_base_url['site'].format(
+                    **data) + self.query_param['page'].format(**data),
+                text=json.dumps(response))
+            c = similarweb.Client(user_key=self.user_key)
+            res = c.referrals(
+                data['domain'], data['start'], data['end'], data['page'],
+                data['main_domain'], fields=('Site', 'Change'))
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res.column('Site'), ['a.com', 'b.com'])
+        self.assertEqual(res[0], {'Site': 'a.com', 'Change': 0.1})
+        self.assertEqual(list(res), [
+            {'Site': 'a.com', 'Change': 0.1},
+            {'Site': 'b.com', 'Change': None}])
+        self.assertEqual(res.meta, {'ResultsCount': 2})
+
+    def test_export(self):
+        response = {
+            'Values': [
+                {'Date': '2013-09-01', 'Value': 10},
+                {'Date': '2013-10-01', 'Value': 20},
+            ],
+        }
+        domains = ['example{0}.com'.format(i) for i in range(5)]
+        out = self._tempdir()
+        with requests_mock.mock() as m:
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v1'
+                data['endpoint'] = 'visits'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['granularity'].format(**data),
+                    text=json.dumps(response),
+                    status_code=404 if i == 0 else 200)
+            c = similarweb.Client(user_key=self.user_key)
+            for fmt in ('ndjson', 'csv'):
+                path = os.path.join(out, 'visits.' + fmt)
+                rows, errors = c.export(
+                    'visits', domains, path, format=fmt, workers=2,
+                    batch_size=3, start=data['start'], end=data['end'],
+                    granularity=data['granularity'],
+                    main_domain=data['main_domain'])
+                self.assertEqual(rows, 8)
+                self.assertEqual([d for d, _ in errors], [domains[0]])
+                with open(path) as f:
+                    lines = f.read().splitlines()
+                if fmt == 'ndjson':
+                    records = [json.loads(line) for line in lines]
+                    self.assertEqual(
+                        sorted(r['domain'] for r in records),
+                        sorted(domains[1:] * 2))
+                    self.assertEqual(
+                        set(r['value'] for r in records), set([10, 20]))
+                else:
+                    self.assertEqual(lines[0], 'domain,date,value')
+                    self.assertEqual(len(lines), 9)
+
+        path = os.path.join(out, 'mixed.csv')
+        writer = similarweb.CSVWriter(path, batch_size=2)
+        writer.write_rows([
+            {'domain': 'a.com', 'Site': 'b.com'},
+            {'domain': 'a.com', 'Site': 'c.com', 'Share': 0.5}])
+        self.assertRaises(ValueError, writer.write, {'value': 1})
+        writer.write({'domain': 'a.com'})
+        writer.close()
+        with open(path) as f:
+            self.assertEqual(f.read().splitlines(), [
+                'domain,Site,Share', 'a.com,b.com,', 'a.com,c.com,0.5',
+                'a.com,,'])
+
+    def test_export_streams_pages(self):
+        out = self._tempdir()
+        path = os.path.join(out, 'referrals.ndjson')
+        written = []
+
+        def page(request, context):
+            number = int(request.qs['page'][0])
+            with open(path) as f:
+                written.append(len(f.read().splitlines()))
+            records = [{'Site': 'site{0}.com'.format(i)}
+                       for i in range(2 * number - 2, min(2 * number, 5))]
+            return json.dumps({'Data': records})
+
+        with requests_mock.mock() as m:
+            m.register_uri(
+                'GET', self.api_base_url['site'].format(
+                    protocol='https', domain='example.com', version='v1',
+                    endpoint='referrals'),
+                text=page)
+            c = similarweb.Client(user_key=self.user_key)
+            rows, errors = c.export(
+                'referrals', ['example.com'], path, batch_size=2,
+                start='9-2013', end='10-2013')
+        self.assertEqual((rows, errors), (5, []))
+        self.assertEqual(written, [0, 2, 4])
+
+    def test_export_schema_mismatch(self):
+        domains = ['example{0}.com'.format(i) for i in range(8)]
+        out = self._tempdir()
+        with requests_mock.mock() as m:
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v1'
+                data['endpoint'] = 'traffic'
+                response = dict(self.response_data)
+                if i == 5:
+                    response['extra'] = 1
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['simple'].format(**data),
+                    text=json.dumps(response))
+            c = similarweb.Client(user_key=self.user_key)
+            path = os.path.join(out, 'traffic.csv')
+            rows, errors = c.export(
+                'traffic', domains, path, format='csv', workers=1,
+                batch_size=3)
+        self.assertEqual(rows, 7)
+        self.assertEqual([d for d, _ in errors], [domains[5]])
+        self.assertIsInstance(errors[0][1], ValueError)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(lines[0], 'domain,foo')
+        self.assertEqual(
+            [line.split(',')[0] for line in lines[1:]],
+            domains[:5] + domains[6:])
+
+    def test_cli_fetch(self):
+        domains = ['example{0}.com'.format(i) for i in range(4)]
+        out = self._tempdir()
+        domains_path = os.path.join(out, 'domains.txt')
+        out_path = os.path.join(out, 'results.ndjson')
+        with open(domains_path, 'w') as f:
+            f.write('# sites\n' + '\n'.join(domains) + '\n\n')
+        with requests_mock.mock() as m:
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v1'
+                data['endpoint'] = 'visits'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['granularity'].format(**data),
+                    text=json.dumps(self.response_data),
+                    status_code=404 if i == 0 else 200)
+            code = similarweb.main([
+                'fetch', '--user-key', self.user_key, '--endpoint', 'visits',
+                '--domains', domains_path, '--start', data['start'],
+                '--end', data['end'], '--granularity', data['granularity'],
+                '--main-domain', '--concurrency', '2', '--retries', '0',
+                '--progress', '0', '--out', out_path])
+        self.assertEqual(code, 1)
+        with open(out_path) as f:
+            records = dict((r['domain'], r)
+                           for r in map(json.loads, f.read().splitlines()))
+        self.assertEqual(sorted(records), domains)
+        self.assertEqual(records[domains[0]]['status'], 404)
+        self.assertEqual(records[domains[1]]['result'], self.response_data)
+
+    def test_checkpoint(self):
+        path = os.path.join(self._tempdir(), 'checkpoint.log')
+        domains = ['example{0}.com'.format(i) for i in range(6)]
+        with requests_mock.mock() as m:
+            for i, domain in enumerate(domains):
+                data = copy.deepcopy(self.test_data[0])
+                data['domain'] = domain
+                data['version'] = 'v2'
+                data['endpoint'] = 'similarsites'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['simple'].format(**data),
+                    text=json.dumps(self.response_data),
+                    status_code=500 if i == 1 else 200)
+            c = similarweb.Client(user_key=self.user_key)
+            checkpoint = similarweb.Checkpoint(path)
+            for n, _ in enumerate(c.bulk(
+                    'similar_sites', domains, workers=1,
+                    checkpoint=checkpoint)):
+                if n == 3:
+                    break
+            checkpoint.close()
+            self.assertEqual(len(checkpoint), 2)
+            with open(path, 'a') as f:
+                f.write('torn')
+            checkpoint = similarweb.Checkpoint(path)
+            self.assertEqual(len(checkpoint), 2)
+            calls = m.call_count
+            res = dict(c.bulk(
+                'similar_sites', domains, workers=2, checkpoint=checkpoint))
+            checkpoint.close()
+        self.assertEqual(len(res), len(domains) - 2)
+        self.assertEqual(m.call_count - calls, len(domains) - 2)
+        self.assertEqual(len(similarweb.Checkpoint(path)), len(domains) - 1)
+
+    def test_checkpoint_shared_log(self):
+        path = os.path.join(self._tempdir(), 'checkpoint.log')
+        keys = [similarweb.Checkpoint.key('traffic', 'example{0}.com'.format(
+            i), {}) for i in range(4)]
+        with open(path, 'w') as f:
+            f.write(keys[0][:7])
+        a = similarweb.Checkpoint(path)
+        a.add(keys[0])
+        b = similarweb.Checkpoint(path)
+        a.add(keys[1])
+        c = similarweb.Checkpoint(path)
+        b.add(keys[2])
+        c.add(keys[3])
+        for checkpoint in (a, b, c):
+            checkpoint.close()
+        self.assertEqual(
+            set(keys), set(similarweb.Checkpoint(path)._done))
+
+    def test_hooks_and_metrics(self):
+        events = []
+        metrics = similarweb.Metrics()
+        with requests_mock.mock() as m:
+            m.register_uri('GET', self._traffic_url(), [
+                {'status_code': 500, 'text': 'oops'},
+                {'text': json.dumps(self.response_data)},
+            ])
+            c = similarweb.Client(
+                user_key=self.user_key, retries=1, backoff=0.01,
+                hooks=[events.append, metrics],
+                cache=similarweb.MemoryCache())
+            c.traffic('example.com')
+            c.traffic('example.com')
+        self.assertEqual(len(events), 2)
+        self.assertEqual(events[0]['endpoint'], 'traffic')
+        self.assertEqual(events[0]['status'], 200)
+        self.assertEqual(events[0]['retries'], 1)
+        self.assertEqual(
+            events[0]['bytes'], len(json.dumps(self.response_data)))
+        self.assertFalse(events[0]['cached'])
+        self.assertTrue(events[1]['cached'])
+        for key in ('request', 'server', 'transfer', 'decode', 'total'):
+            self.assertGreaterEqual(events[0][key], 0)
+        summary = metrics.summary()['traffic']
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['errors'], 0)
+        self.assertLessEqual(summary['p50'], summary['p99'])
+        text = metrics.prometheus()
+        self.assertIn(
+            'similarweb_request_duration_seconds_count{endpoint="traffic"} 2',
+            text)
+        self.assertIn(
+            'similarweb_request_duration_seconds_bucket'
+            '{endpoint="traffic",le="+Inf"} 2', text)
+
+        metrics = similarweb.Metrics()
+        with requests_mock.mock() as m:
+            self._register_category(m)
+            c = similarweb.Client(user_key=self.user_key, hooks=[metrics])
+            c.category('example.com')
+            c.adult('example.com')
+            m.register_uri(
+                'GET', c._site_prefix + 'example.com/v2/similarsites',
+                text='{}')
+            c.similar_sites('example.com')
+        self.assertEqual(
+            sorted(metrics.summary()), ['category', 'similar_sites'])
+
+    def test_latency_histogram(self):
+        h = similarweb.LatencyHistogram()
+        for i in range(1, 101):
+            h.observe(i / 1000.0)
+        self.assertAlmostEqual(h.percentile(50), 0.05, delta=0.01)
+        self.assertAlmostEqual(h.percentile(99), 0.099, delta=0.02)
+
+    def test_key_pool(self):
+        keys = ['key1', 'key2', 'bad']
+        with requests_mock.mock() as m:
+            for key in keys:
+                data = copy.deepcopy(self.test_data[0])
+                data['user_key'] = key
+                data['version'] = 'v1'
+                data['endpoint'] = 'traffic'
+                m.register_uri(
+                    'GET',
+                    self.api_base_url['site'].format(
+                        **data) + self.query_param['simple'].format(**data),
+                    text=json.dumps(self.response_data),
+                    status_code=403 if key == 'bad' else 200)
+            c = similarweb.Client(user_key=keys)
+            for _ in range(6):
+                self.assertEqual(c.traffic('example.com'), self.response_data)
+            used = [r.qs['userkey'][0] for r in m.request_history]
+        self.assertEqual(used.count('bad'), 1)
+        self.assertEqual(used.count('key1'), 3)
+        self.assertEqual(used.count('key2'), 3)
+
+        pool = similarweb.KeyPool(
+            ['key1', 'key2'], strategy='quota', quotas={'key1': 1, 'key2': 3})
+        self.assertEqual(
+            [pool.next() for _ in range(4)], ['key2', 'key2', 'key1', 'key2'])
+        pool.disable('key1')
+        pool.disable('key2')
+        with self.assertRaises(similarweb.QuotaError):
+            pool.next()
+
+    def test_record_replay_transport(self):
+        path = os.path.join(self._tempdir(), 'archive')
+        with requests_mock.mock() as m:
+            m.register_uri(
+                'GET', self._traffic_url(),
+                text=json.dumps(self.response_data))
+            m.register_uri(
+                'GET', self._traffic_url().replace('example.com', 'nx.com'),
+                status_code=404, text='nope')
+            recorder = similarweb.RecordingTransport(path)
+            c = similarweb.Client(user_key=self.user_key, transport=recorder)
+            c.traffic('example.com')
+            with self.assertRaises(similarweb.NotFoundError):
+                c.traffic('nx.com')
+            recorder.close()
+
+        replay = similarweb.ReplayTransport(path, latency=0.01)
+        self.assertEqual(len(replay), 2)
+        c = similarweb.Client(user_key='other', transport=replay)
+        start = time.time()
+        self.assertEqual(c.traffic('example.com'), self.response_data)
+        self.assertGreaterEqual(time.time() - start, 0.01)
+        with self.assertRaises(similarweb.NotFoundError) as cm:
+            c.traffic('nx.com')
+        self.assertEqual(cm.exception.body, 'nope')
+        c = similarweb.Client(
+            user_key=self.user_key,
+            transport=similarweb.ReplayTransport(path, error_rate=1))
+        with self.assertRaises(similarweb.ServerError):
+            c.traffic('example.com')
+
+    def test_rate_limiter(self):
+        limiter = similarweb.RateLimiter(rate=100)
+        start = time.time()
+        for _ in range(11):
+            limiter.acquire()
+            limiter.release()
+        self.assertGreaterEqual(time.time() - start, 0.09)
+
+    def test_adaptive_rate_limiter(self):
+        def every_third_throttled(handler, count):
+            if count % 3 == 0:
+                return 429, {'Retry-After': '0'}, b'slow down'
+            return 200, {}, json.dumps({'foo': 'bar'}).encode('utf-8')
+
+        domains = ['example{0}.com'.format(i) for i in range(20)]
+        limiter = similarweb.RateLimiter(
+            rate=1000, concurrency=4, adaptive=True)
+        with _StubServer(responder=every_third_throttled) as server:
+            c = server.client(rate_limiter=limiter)
+            res = dict(c.bulk('traffic', domains, workers=4))
+            self.assertGreater(server.request_count, len(domains))
+        self.assertEqual(
+            res, dict((d, self.response_data) for d in domains))
+        self.assertLess(limiter.rate, limiter.max_rate)
+        self.assertEqual(limiter.in_flight, 0)
+
+    def test_rate_limiter_backs_off_on_failures(self):
+        limiter = similarweb.RateLimiter(
+            rate=100, concurrency=2, adaptive=True, max_retries=5)
+        with requests_mock.mock() as m:
+            m.register_uri('GET', self._traffic_url(),
+                           exc=requests.exceptions.ReadTimeout)
+            c = similarweb.Client(user_key=self.user_key, rate_limiter=limiter)
+            for _ in range(4):
+                with self.assertRaises(similarweb.RequestTimeoutError):
+                    c.traffic('example.com')
+        self.assertLess(limiter.rate, limiter.max_rate)
+        self.assertLessEqual(limiter.concurrency, 2)
+
+        limiter = similarweb.RateLimiter(rate=1000, max_retries=5)
+        with requests_mock.mock() as m, mock.patch.object(
+                similarweb.random, 'uniform', lambda a, b: b):
+            m.register_uri('GET', self._traffic_url(), status_code=503)
+            c = similarweb.Client(
+                user_key=self.user_key, rate_limiter=limiter, backoff=0.01)
+            start = time.time()
+            with self.assertRaises(similarweb.ServerError):
+                c.traffic('example.com')
+            self.assertGreaterEqual(time.time() - start, 0.3)
+            self.assertEqual(m.call_count, 6)
+
+    def test_async_client_mirrors_endpoints(self):
+        for name in similarweb._ENDPOINT_METHODS:
+            self.assertTrue(
+                asyncio.iscoroutinefunction(
+                    getattr(similarweb.AsyncClient, name)), name)
+
+    def test_async_client_concurrency(self):
+        domains = ['example{0}.com'.format(i) for i in range(20)]
+        with _StubServer(delay=0.05) as server:
+            c = server.client()
+            start = time.time()
+            expected = [c.traffic(d) for d in domains]
+            sequential = time.time() - start
+
+            async def fetch_all(ac):
+                return await asyncio.gather(*[ac.traffic(d) for d in domains])
+
+            ac = server.client(similarweb.AsyncClient, concurrency=10)
+            start = time.time()
+            res = asyncio.run(fetch_all(ac))
+            concurrent = time.time() - start
+            ac.close()
+        self.assertEqual(res, expected)
+        self.assertLess(concurrent, sequential / 3)
+
+    def test_async_client_across_loops(self):
+        domains = ['example{0}.com'.format(i) for i in range(6)]
+        with _StubServer() as server:
+            ac = server.client(similarweb.AsyncClient, concurrency=2)
+
+            async def fetch_all():
+                return await asyncio.gather(*[ac.traffic(d) for d in domains])
+
+            for _ in range(2):
+                self.assertEqual(
+                    asyncio.run(fetch_all()), [self.response_data] * 6)
+            ac.close()
+
 if __name__ == '__main__':
     unittest.main()